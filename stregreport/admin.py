@@ -1 +1,11 @@
-# Register your models here.
+from django.contrib import admin
+
+from stregreport.models import RankGroup
+
+
+class RankGroupAdmin(admin.ModelAdmin):
+    list_display = ('name', 'position')
+    filter_horizontal = ('products',)
+
+
+admin.site.register(RankGroup, RankGroupAdmin)
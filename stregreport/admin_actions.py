@@ -1,11 +1,2 @@
-def toggle_active_selected_products(modeladmin, request, queryset):
-    "toggles active on products, also removes deactivation date."
-    # This is horrible since it does not use update, but update will
-    # not do not F('active') so we are doing this. I am sorry.
-    for obj in queryset:
-        obj.deactivate_date = None
-        obj.active = not obj.active
-        obj.save()
-
-
-toggle_active_selected_products.short_description = "Toggle Active"
+# The action lives with the product admin, this is kept so old imports work
+from stregsystem.admin import toggle_active_selected_products  # noqa: F401
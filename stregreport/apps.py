@@ -1,5 +1,20 @@
 from django.apps import AppConfig
 
+from django.db.models.signals import m2m_changed, post_delete, post_save
+
 
 class StregreportConfig(AppConfig):
     name = 'stregreport'
+
+    def ready(self):
+        from stregreport.models import RankGroup
+        from stregreport import ranks, rollups
+        from stregsystem.models import Sale
+        from stregsystem.signals import sales_refunded
+
+        sales_refunded.connect(ranks.after_sales_refund, sender=Sale)
+        sales_refunded.connect(rollups.after_sales_refund, sender=Sale)
+
+        post_save.connect(ranks.forget_ranks, sender=RankGroup)
+        post_delete.connect(ranks.forget_ranks, sender=RankGroup)
+        m2m_changed.connect(ranks.forget_ranks, sender=RankGroup.products.through)
@@ -0,0 +1,20 @@
+from django.core.management import BaseCommand
+
+from stregreport.models import RankYear
+from stregreport.ranks import update_ranks
+
+
+class Command(BaseCommand):
+    help = "Rebuild the materialized ranks from the sale history, e.g. after sales have been edited"
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            'years', nargs='*', type=int, help="The years to rebuild, defaults to all materialized years"
+        )
+
+    def handle(self, *args, **options):
+        years = options['years'] or list(RankYear.objects.values_list('year', flat=True))
+        for year in years:
+            update_ranks(year, rebuild=True)
+
+        self.stdout.write(self.style.SUCCESS(f'[rebuildranks] Rebuilt the ranks of {len(years)} years'))
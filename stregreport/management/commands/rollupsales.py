@@ -0,0 +1,29 @@
+import argparse
+
+from django.core.management import BaseCommand
+from django.utils.dateparse import parse_date
+
+from stregreport.rollups import rollup_sales
+
+
+def _date(value):
+    date = parse_date(value)
+    if date is None:
+        raise argparse.ArgumentTypeError(f"'{value}' is not a date (YYYY-MM-DD)")
+    return date
+
+
+class Command(BaseCommand):
+    help = "Roll up the sales of the days which have ended into daily totals for the reports"
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--since',
+            type=_date,
+            help="Roll up again from this day (YYYY-MM-DD), e.g. after sales have been edited",
+        )
+
+    def handle(self, *args, **options):
+        days = rollup_sales(since=options['since'])
+
+        self.stdout.write(self.style.SUCCESS(f'[rollupsales] Rolled up {days} days'))
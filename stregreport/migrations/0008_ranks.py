@@ -0,0 +1,106 @@
+# Generated by Django 2.2.24 on 2026-10-18 18:07
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+# The product groups which used to be hardcoded in the ranks view
+RANK_GROUPS = [
+    (
+        "Øl",
+        [
+            13,
+            14,
+            29,
+            42,
+            47,
+            54,
+            65,
+            66,
+            1773,
+            1776,
+            1777,
+            1779,
+            1780,
+            1783,
+            1793,
+            1794,
+            1807,
+            1808,
+            1809,
+            1820,
+            1822,
+            1840,
+            1844,
+            1846,
+            1847,
+            1853,
+            1855,
+            1856,
+            1858,
+            1859,
+        ],
+    ),
+    ("Koffein", [11, 12, 30, 34, 37, 1787, 1790, 1791, 1795, 1799, 1800, 1803, 1804, 1837, 1864]),
+    ("Mælkeprodukter", [2, 3, 4, 5, 6, 7, 8, 9, 10, 16, 17, 18, 19, 20, 24, 25, 43, 44, 45, 1865]),
+    ("Kaffe", [32, 35, 36, 39]),
+    ("Vitaminvand", [1850, 1851, 1852, 1863]),
+]
+
+
+def seed_rank_groups(apps, schema_editor):
+    RankGroup = apps.get_model('stregreport', 'RankGroup')
+    Product = apps.get_model('stregsystem', 'Product')
+    for position, (name, product_ids) in enumerate(RANK_GROUPS):
+        group = RankGroup.objects.create(name=name, position=position)
+        group.products.set(Product.objects.filter(id__in=product_ids))
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('stregsystem', '0016_member_bac'),
+        ('stregreport', '0007_auto_20200305_0917'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='RankYear',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('year', models.IntegerField(unique=True)),
+                ('last_sale_id', models.IntegerField(default=0)),
+                ('closed', models.BooleanField(default=False)),
+            ],
+        ),
+        migrations.CreateModel(
+            name='RankGroup',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('name', models.CharField(max_length=64)),
+                ('position', models.IntegerField(default=0)),
+                ('products', models.ManyToManyField(blank=True, to='stregsystem.Product')),
+            ],
+            options={
+                'ordering': ['position', 'id'],
+            },
+        ),
+        migrations.CreateModel(
+            name='RankEntry',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('value', models.IntegerField(default=0)),
+                (
+                    'group',
+                    models.ForeignKey(
+                        blank=True, null=True, on_delete=django.db.models.deletion.CASCADE, to='stregreport.RankGroup'
+                    ),
+                ),
+                ('member', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='stregsystem.Member')),
+                ('year', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='stregreport.RankYear')),
+            ],
+            options={
+                'index_together': {('year', 'group', 'value')},
+            },
+        ),
+        migrations.RunPython(seed_rank_groups, migrations.RunPython.noop),
+    ]
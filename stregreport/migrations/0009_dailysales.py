@@ -0,0 +1,34 @@
+# Generated by Django 2.2.24 on 2026-10-18 18:09
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('stregsystem', '0016_member_bac'),
+        ('stregreport', '0008_ranks'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='DailySales',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('date', models.DateField()),
+                ('count', models.IntegerField(default=0)),
+                ('revenue', models.IntegerField(default=0)),
+                ('product', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='stregsystem.Product')),
+                (
+                    'room',
+                    models.ForeignKey(
+                        blank=True, null=True, on_delete=django.db.models.deletion.CASCADE, to='stregsystem.Room'
+                    ),
+                ),
+            ],
+            options={
+                'unique_together': {('date', 'product', 'room')},
+            },
+        ),
+    ]
@@ -0,0 +1,37 @@
+# Generated by Django 2.2.24 on 2026-10-18 18:46
+
+from django.db import migrations, models
+
+
+def forget_duplicated_ranks(apps, schema_editor):
+    # A year with duplicated entries has counted some sales twice. Its ranks
+    # are rebuilt from the sales the next time they are shown.
+    RankEntry = apps.get_model('stregreport', 'RankEntry')
+    RankYear = apps.get_model('stregreport', 'RankYear')
+    duplicated = (
+        RankEntry.objects.values('year', 'group', 'member')
+        .annotate(entries=models.Count('id'))
+        .filter(entries__gt=1)
+        .values('year')
+    )
+    RankYear.objects.filter(id__in=duplicated).delete()
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('stregsystem', '0020_oldprice_product_changed_on'),
+        ('stregreport', '0009_dailysales'),
+    ]
+
+    operations = [
+        migrations.RunPython(forget_duplicated_ranks, migrations.RunPython.noop),
+        migrations.AlterUniqueTogether(
+            name='rankentry',
+            unique_together={('year', 'group', 'member')},
+        ),
+        migrations.AddConstraint(
+            model_name='rankentry',
+            constraint=models.UniqueConstraint(condition=models.Q(group__isnull=True), fields=('year', 'member'), name='unique_money_rank_entry'),
+        ),
+    ]
@@ -1,6 +1,6 @@
 from django.db import models
 
-from stregsystem.models import Member
+from stregsystem.models import Member, Product, Room
 
 
 class BreadRazzia(models.Model):
@@ -19,3 +19,78 @@ class RazziaEntry(models.Model):
     member = models.ForeignKey(Member, on_delete=models.CASCADE)
     razzia = models.ForeignKey(BreadRazzia, on_delete=models.CASCADE)
     time = models.DateTimeField(null=True, blank=True, auto_now_add=True)
+
+
+class RankGroup(models.Model):
+    """
+    A column on the ranks page, ranking members by how many of the products
+    in the group they have bought during the year.
+    """
+
+    name = models.CharField(max_length=64)
+    products = models.ManyToManyField(Product, blank=True)
+    position = models.IntegerField(default=0)
+
+    class Meta:
+        ordering = ['position', 'id']
+
+    def __str__(self):
+        return self.name
+
+
+class RankYear(models.Model):
+    """
+    The materialized ranks of a year contain all sales up to last_sale_id. A
+    closed year has passed its fjuleparty and won't change anymore.
+    """
+
+    year = models.IntegerField(unique=True)
+    last_sale_id = models.IntegerField(default=0)
+    closed = models.BooleanField(default=False)
+
+    def __str__(self):
+        return str(self.year)
+
+
+class RankEntry(models.Model):
+    """
+    What a member has bought in a year. For a rank group value is the number
+    of products bought, without a group it's the money spent.
+    """
+
+    year = models.ForeignKey(RankYear, on_delete=models.CASCADE)
+    group = models.ForeignKey(RankGroup, null=True, blank=True, on_delete=models.CASCADE)
+    member = models.ForeignKey(Member, on_delete=models.CASCADE)
+    value = models.IntegerField(default=0)
+
+    class Meta:
+        index_together = [
+            ["year", "group", "value"],
+        ]
+        unique_together = [
+            ["year", "group", "member"],
+        ]
+        constraints = [
+            # NULLs are distinct in unique_together, so the money spent needs its own
+            models.UniqueConstraint(
+                fields=["year", "member"], condition=models.Q(group__isnull=True), name="unique_money_rank_entry"
+            ),
+        ]
+
+
+class DailySales(models.Model):
+    """
+    The sales of a product in a room on a (local) day, rolled up by the
+    rollupsales command so the reports don't have to aggregate old sales.
+    """
+
+    date = models.DateField()
+    product = models.ForeignKey(Product, on_delete=models.CASCADE)
+    room = models.ForeignKey(Room, null=True, blank=True, on_delete=models.CASCADE)
+    count = models.IntegerField(default=0)
+    revenue = models.IntegerField(default=0)
+
+    class Meta:
+        unique_together = [
+            ["date", "product", "room"],
+        ]
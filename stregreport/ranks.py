@@ -0,0 +1,160 @@
+import datetime
+from collections import Counter, defaultdict
+
+import pytz
+from django.db import transaction
+from django.db.models import Count, Max, Sum
+from django.utils import timezone
+
+from stregreport.models import RankEntry, RankGroup, RankYear
+from stregsystem.models import Sale
+
+# Sales are only added to the ranks once they are this old. Sale ids are
+# handed out before the sales are committed, so a sale with a lower id may
+# show up after one with a higher id. Waiting a bit makes sure no sale below
+# the watermark is still in flight.
+RANK_SETTLE_TIME = datetime.timedelta(minutes=1)
+
+
+# date of fjuleparty (first friday of december) for the given year at
+# 10 o'clock
+def fjule_party(year):
+    first_december = timezone.datetime(year, 12, 1, 22, tzinfo=pytz.timezone("Europe/Copenhagen"))
+    days_to_add = (11 - first_december.weekday()) % 7
+    return first_december + datetime.timedelta(days=days_to_add)
+
+
+# the ranks year the timestamp belongs to, the years run from just after one
+# fjuleparty to the next
+def fjule_party_year(timestamp):
+    if timestamp > fjule_party(timestamp.year):
+        return timestamp.year + 1
+    return timestamp.year
+
+
+def _add_sales(rank_year, sales, sign=1):
+    """
+    Adds the given sales to the materialized ranks of the year, or takes them
+    out if sign is -1. The sales are given as (member_id, product_id, count,
+    price) with the count and total price of the member's sales of the
+    product. The RankYear row must be locked. Taking sales out only changes
+    existing entries, as a missing entry belongs to a member being deleted.
+    """
+    groups_of_product = defaultdict(list)
+    for group_id, product_id in RankGroup.products.through.objects.values_list('rankgroup_id', 'product_id'):
+        groups_of_product[product_id].append(group_id)
+
+    values = defaultdict(int)
+    for member_id, product_id, count, price in sales:
+        values[(None, member_id)] += sign * price
+        for group_id in groups_of_product[product_id]:
+            values[(group_id, member_id)] += sign * count
+
+    if not values:
+        return
+
+    entries = {
+        (entry.group_id, entry.member_id): entry
+        for entry in RankEntry.objects.filter(year=rank_year, member_id__in={member_id for _, member_id in values})
+    }
+    changed, new = [], []
+    for (group_id, member_id), value in values.items():
+        entry = entries.get((group_id, member_id))
+        if entry is None:
+            if sign > 0:
+                new.append(RankEntry(year=rank_year, group_id=group_id, member_id=member_id, value=value))
+        else:
+            entry.value += value
+            changed.append(entry)
+    RankEntry.objects.bulk_update(changed, ['value'])
+    RankEntry.objects.bulk_create(new)
+
+
+@transaction.atomic
+def update_ranks(year, rebuild=False):
+    """
+    Brings the materialized ranks of the year up to date, by adding the sales
+    made since the last update. Closed years are left alone, unless they are
+    rebuilt from scratch.
+    """
+    from_time = fjule_party(year - 1)
+    to_time = fjule_party(year)
+    settled_time = timezone.now() - RANK_SETTLE_TIME
+
+    rank_year, _ = RankYear.objects.select_for_update().get_or_create(year=year)
+    if rebuild:
+        RankEntry.objects.filter(year=rank_year).delete()
+        rank_year.last_sale_id = 0
+        rank_year.closed = False
+    if rank_year.closed:
+        return rank_year
+
+    settled_sale_id = Sale.objects.filter(id__gt=rank_year.last_sale_id, timestamp__lte=settled_time).aggregate(
+        Max('id')
+    )['id__max']
+    if settled_sale_id is not None:
+        _add_sales(
+            rank_year,
+            Sale.objects.filter(
+                id__gt=rank_year.last_sale_id,
+                id__lte=settled_sale_id,
+                timestamp__gt=from_time,
+                timestamp__lte=to_time,
+            )
+            .values_list('member_id', 'product_id')
+            .annotate(Count('id'), Sum('price')),
+        )
+        rank_year.last_sale_id = settled_sale_id
+    rank_year.closed = to_time <= settled_time
+    rank_year.save()
+    return rank_year
+
+
+def year_ranks(year, rank_limit=10):
+    """
+    Returns the top of each rank group for the year as a list of
+    (group, entries), and the top spenders as a list of entries.
+    """
+    rank_year = update_ranks(year)
+    entries = RankEntry.objects.filter(year=rank_year, value__gt=0).select_related('member')
+    group_ranks = [
+        (group, list(entries.filter(group=group).order_by('-value', 'member__username')[:rank_limit]))
+        for group in RankGroup.objects.all()
+    ]
+    money_rank = list(
+        entries.filter(group__isnull=True, member__active=True).order_by('-value', 'member__username')[:rank_limit]
+    )
+    return group_ranks, money_rank
+
+
+def forget_ranks(**kwargs):
+    """
+    Drops all materialized ranks, they are rebuilt the next time they are
+    shown. Used when the rank groups change.
+    """
+    RankYear.objects.all().delete()
+
+
+def after_sales_refund(sender, sales, **kwargs):
+    """
+    Takes refunded sales out of the ranks again, if they have been added.
+    """
+    sales_of_year = defaultdict(list)
+    for sale in sales:
+        sales_of_year[fjule_party_year(sale.timestamp)].append(sale)
+
+    with transaction.atomic():
+        for rank_year in RankYear.objects.select_for_update().filter(year__in=sales_of_year).order_by('year'):
+            counts, prices = Counter(), Counter()
+            for sale in sales_of_year[rank_year.year]:
+                if sale.id <= rank_year.last_sale_id:
+                    counts[(sale.member_id, sale.product_id)] += 1
+                    prices[(sale.member_id, sale.product_id)] += sale.price
+            _add_sales(
+                rank_year,
+                [
+                    (member_id, product_id, count, prices[(member_id, product_id)])
+                    for (member_id, product_id), count in counts.items()
+                ],
+                sign=-1,
+            )
@@ -0,0 +1,100 @@
+import datetime
+from collections import Counter
+
+from django.db import transaction
+from django.db.models import Count, F, Max, Q, Sum
+from django.db.models.functions import TruncDate
+from django.utils import timezone
+
+from stregreport.models import DailySales
+from stregsystem.models import Sale
+
+
+def _midnight(date):
+    return timezone.make_aware(datetime.datetime.combine(date, datetime.time()))
+
+
+def rolled_up_until():
+    """
+    The last day which has been rolled up, or None if nothing has. The days
+    are always rolled up in order, so every day before it has been too.
+    """
+    return DailySales.objects.aggregate(Max('date'))['date__max']
+
+
+@transaction.atomic
+def rollup_sales(since=None):
+    """
+    Rolls up the sales of every day which has ended, starting from the day
+    after the last rolled up day, or from since if given. Days which are
+    rolled up again are replaced. Returns the number of days rolled up.
+    """
+    yesterday = timezone.localdate() - datetime.timedelta(days=1)
+    if since is None:
+        last_day = rolled_up_until()
+        if last_day is not None:
+            since = last_day + datetime.timedelta(days=1)
+        else:
+            first_sale = Sale.objects.order_by('timestamp').values_list('timestamp', flat=True).first()
+            if first_sale is None:
+                return 0
+            since = timezone.localtime(first_sale).date()
+    if since > yesterday:
+        return 0
+
+    DailySales.objects.filter(date__gte=since).delete()
+    rows = (
+        Sale.objects.filter(
+            timestamp__gte=_midnight(since), timestamp__lt=_midnight(yesterday + datetime.timedelta(days=1))
+        )
+        .annotate(date=TruncDate('timestamp'))
+        .values('date', 'product_id', 'room_id')
+        .annotate(count=Count('id'), revenue=Sum('price'))
+    )
+    DailySales.objects.bulk_create(DailySales(**row) for row in rows)
+    return (yesterday - since).days + 1
+
+
+def split_period(from_time, to_time):
+    """
+    Splits the period (from_time, to_time] in the whole days in it which have
+    been rolled up, and the rest, which has to be read from the sales.
+
+    Returns the first and last rolled up day of the period, or None if there
+    are none, and a function giving a Q for the sales in the rest.
+    """
+    first_day = timezone.localtime(from_time).date() + datetime.timedelta(days=1)
+    last_day = timezone.localtime(to_time).date() - datetime.timedelta(days=1)
+    until = rolled_up_until()
+    if until is None or min(last_day, until) < first_day:
+        return None, lambda prefix='': Q(**{prefix + 'timestamp__gt': from_time, prefix + 'timestamp__lte': to_time})
+    last_day = min(last_day, until)
+
+    def rest(prefix=''):
+        return Q(**{prefix + 'timestamp__gt': from_time, prefix + 'timestamp__lt': _midnight(first_day)}) | Q(
+            **{
+                prefix + 'timestamp__gte': _midnight(last_day + datetime.timedelta(days=1)),
+                prefix + 'timestamp__lte': to_time,
+            }
+        )
+
+    return (first_day, last_day), rest
+
+
+def after_sales_refund(sender, sales, **kwargs):
+    """
+    Takes refunded sales out of their days, if the days have been rolled up.
+    """
+    until = rolled_up_until()
+    if until is None:
+        return
+    counts, revenues = Counter(), Counter()
+    for sale in sales:
+        key = (timezone.localtime(sale.timestamp).date(), sale.product_id, sale.room_id)
+        if key[0] <= until:
+            counts[key] += 1
+            revenues[key] += sale.price
+    for (date, product_id, room_id), count in counts.items():
+        DailySales.objects.filter(date=date, product_id=product_id, room_id=room_id).update(
+            count=F('count') - count, revenue=F('revenue') - revenues[(date, product_id, room_id)]
+        )
@@ -1,7 +1,21 @@
-from django.test import TestCase
+import datetime
+import json
+from io import StringIO
+
+from unittest.mock import patch
+
+from django.contrib.auth.models import User
+from django.core.management import CommandError, call_command
+from django.db import IntegrityError, connection, transaction
+from django.test import TestCase, TransactionTestCase
+from django.test.utils import CaptureQueriesContext
 from django.urls import reverse
+from freezegun import freeze_time
 from stregreport import views
-from stregreport.models import BreadRazzia
+from stregreport.models import BreadRazzia, DailySales, RankEntry, RankGroup, RankYear
+from stregreport.ranks import fjule_party, fjule_party_year, update_ranks, year_ranks
+from stregreport.rollups import rolled_up_until, rollup_sales
+from stregsystem.models import Category, Member, Product, Room, Sale
 
 
 class ParseIdStringTests(TestCase):
@@ -149,3 +163,328 @@ class RazziaTests(TestCase):
         self.assertEqual(response_add.status_code, 200)
         self.assertTemplateUsed(response_members, "admin/stregsystem/razzia/members.html")
         self.assertContains(response_members, "jokke", status_code=200)
+
+
+class RanksTests(TestCase):
+    fixtures = ["initial_data"]
+
+    def setUp(self):
+        self.jokke = Member.objects.get(username="jokke")
+        self.jan = Member.objects.get(username="jan")
+        self.beer = Product.objects.get(id=1)
+        self.milk = Product.objects.get(id=2)
+        RankGroup.objects.all().delete()
+        self.beer_group = RankGroup.objects.create(name="Øl", position=0)
+        self.beer_group.products.add(self.beer)
+        self.milk_group = RankGroup.objects.create(name="Mælk", position=1)
+        self.milk_group.products.add(self.milk)
+
+    def buy(self, member, product, timestamp):
+        with freeze_time(timestamp):
+            return Sale.objects.create(member=member, product=product, price=product.price)
+
+    def values(self, stat_list):
+        return [(entry.member.username, entry.value) for entry in stat_list]
+
+    def test_fjule_party_year(self):
+        self.assertEqual(2019, fjule_party_year(fjule_party(2019)))
+        self.assertEqual(2020, fjule_party_year(fjule_party(2019) + datetime.timedelta(seconds=1)))
+
+    def test_ranks_for_closed_year(self):
+        day = fjule_party(2018) + datetime.timedelta(days=30)
+        for _ in range(3):
+            self.buy(self.jan, self.beer, day)
+        self.buy(self.jokke, self.beer, day)
+        self.buy(self.jokke, self.milk, day)
+        # Outside the year
+        self.buy(self.jokke, self.beer, fjule_party(2018))
+
+        self.client.login(username="tester", password="treotreo")
+        response = self.client.get("/admin/stregsystem/report/ranks/2019")
+
+        self.assertEqual(response.status_code, 200)
+        group_stat_lists = response.context["group_stat_lists"]
+        self.assertEqual([self.beer_group, self.milk_group], [group for group, _ in group_stat_lists])
+        self.assertEqual([("jan", 3), ("jokke", 1)], self.values(group_stat_lists[0][1]))
+        self.assertEqual([("jokke", 1)], self.values(group_stat_lists[1][1]))
+        self.assertEqual(
+            [("jan", 3 * self.beer.price), ("jokke", self.beer.price + self.milk.price)],
+            self.values(response.context["kr_stat_list"]),
+        )
+        self.assertTrue(RankYear.objects.get(year=2019).closed)
+
+    def test_closed_year_is_not_recomputed(self):
+        self.buy(self.jan, self.beer, fjule_party(2018) + datetime.timedelta(days=30))
+        update_ranks(2019)
+
+        # Reading a closed year doesn't touch the sales at all
+        with self.assertNumQueries(7):
+            group_ranks, money_rank = year_ranks(2019)
+        self.assertEqual([("jan", 1)], self.values(group_ranks[0][1]))
+
+        # Backdated sales are only picked up by a rebuild
+        self.buy(self.jan, self.beer, fjule_party(2018) + datetime.timedelta(days=31))
+        call_command('rebuildranks', '2019', stdout=StringIO())
+        self.assertEqual(2, RankEntry.objects.get(year__year=2019, group=self.beer_group).value)
+
+    def test_entries_are_unique(self):
+        self.buy(self.jan, self.beer, fjule_party(2018) + datetime.timedelta(days=30))
+        rank_year = update_ranks(2019)
+
+        for group in [self.beer_group, None]:
+            with self.assertRaises(IntegrityError), transaction.atomic():
+                RankEntry.objects.create(year=rank_year, group=group, member=self.jan, value=1)
+
+    def test_ongoing_year_is_updated_incrementally(self):
+        day = fjule_party(2019) + datetime.timedelta(days=30)
+        self.buy(self.jan, self.beer, day)
+        with freeze_time(day + datetime.timedelta(hours=1)):
+            update_ranks(2020)
+        self.buy(self.jan, self.beer, day + datetime.timedelta(hours=2))
+        # Not settled yet
+        self.buy(self.jokke, self.beer, day + datetime.timedelta(hours=3))
+
+        with freeze_time(day + datetime.timedelta(hours=3)):
+            group_ranks, _ = year_ranks(2020)
+
+        self.assertEqual([("jan", 2)], self.values(group_ranks[0][1]))
+        self.assertFalse(RankYear.objects.get(year=2020).closed)
+
+    def test_refund_is_removed_from_ranks(self):
+        day = fjule_party(2018) + datetime.timedelta(days=30)
+        self.buy(self.jan, self.beer, day)
+        sale = self.buy(self.jan, self.beer, day)
+        update_ranks(2019)
+
+        sale.delete()
+
+        group_ranks, money_rank = year_ranks(2019)
+        self.assertEqual([("jan", 1)], self.values(group_ranks[0][1]))
+        self.assertEqual([("jan", self.beer.price)], self.values(money_rank))
+
+    def test_grouped_refund_is_removed_from_ranks(self):
+        day = fjule_party(2018) + datetime.timedelta(days=30)
+        self.buy(self.jan, self.beer, day)
+        refunded = [self.buy(self.jan, self.beer, day).id, self.buy(self.jokke, self.milk, day).id]
+        # Not in the ranks yet
+        refunded.append(self.buy(self.jokke, self.milk, fjule_party(2019) + datetime.timedelta(days=1)).id)
+        update_ranks(2019)
+
+        Sale.refund(Sale.objects.filter(pk__in=refunded), User.objects.get(username="tester"))
+
+        group_ranks, money_rank = year_ranks(2019)
+        self.assertEqual([("jan", 1)], self.values(group_ranks[0][1]))
+        self.assertEqual([], self.values(group_ranks[1][1]))
+        self.assertEqual([("jan", self.beer.price)], self.values(money_rank))
+
+    def test_deleted_product_is_removed_from_ranks(self):
+        day = fjule_party(2018) + datetime.timedelta(days=30)
+        self.buy(self.jan, self.beer, day)
+        self.buy(self.jan, self.milk, day)
+        update_ranks(2019)
+
+        self.milk.delete()
+
+        group_ranks, money_rank = year_ranks(2019)
+        self.assertEqual([("jan", 1)], self.values(group_ranks[0][1]))
+        self.assertEqual([("jan", self.beer.price)], self.values(money_rank))
+
+    def test_changing_rank_group_forgets_ranks(self):
+        self.buy(self.jan, self.milk, fjule_party(2018) + datetime.timedelta(days=30))
+        update_ranks(2019)
+
+        self.beer_group.products.add(self.milk)
+
+        self.assertFalse(RankYear.objects.filter(year=2019).exists())
+        group_ranks, _ = year_ranks(2019)
+        self.assertEqual([("jan", 1)], self.values(group_ranks[0][1]))
+
+
+class DailySalesTests(TestCase):
+    fixtures = ["initial_data"]
+
+    now = datetime.datetime(2021, 3, 15, 12, 0, tzinfo=datetime.timezone.utc)
+
+    def setUp(self):
+        self.client.login(username="tester", password="treotreo")
+        self.jan = Member.objects.get(username="jan")
+        self.room = Room.objects.get(id=1)
+        self.beer = Product.objects.get(id=1)
+        self.milk = Product.objects.get(id=2)
+        category = Category.objects.create(name="Drikkevarer")
+        self.beer.categories.add(category)
+        for days_ago, product in [(40, self.beer), (20, self.beer), (20, self.milk), (5, self.beer), (0, self.milk)]:
+            for hours in [1, 23]:
+                with freeze_time(self.now - datetime.timedelta(days=days_ago, hours=hours)):
+                    Sale.objects.create(member=self.jan, product=product, room=self.room, price=product.price)
+
+    def reports(self):
+        with freeze_time(self.now):
+            daily = self.client.get("/admin/stregsystem/report/daily/")
+            sales_api = json.loads(self.client.get("/admin/stregsystem/report/sales_api").content)
+            sales = self.client.post(
+                reverse("salesreporting"),
+                {"products": "1 2", "from_date": "2021-02-10", "to_date": "2021-03-14"},
+            )
+        return (
+            daily.context["revenue_month"],
+            [(c.name, c.sale) for c in daily.context["top_month_category"]],
+            sales_api,
+            sales.context["sales"],
+        )
+
+    def test_rollup_only_closed_days(self):
+        with freeze_time(self.now):
+            rollup_sales()
+
+        self.assertEqual(datetime.date(2021, 3, 14), rolled_up_until())
+        self.assertFalse(DailySales.objects.filter(date=datetime.date(2021, 3, 15)).exists())
+        rolled_up = DailySales.objects.get(date=datetime.date(2021, 2, 23), product=self.milk, room=self.room)
+        self.assertEqual(1, rolled_up.count)
+        self.assertEqual(self.milk.price, rolled_up.revenue)
+
+    def test_reports_match_raw_sales(self):
+        before = self.reports()
+        with freeze_time(self.now):
+            call_command('rollupsales', stdout=StringIO())
+
+        with freeze_time(self.now), self.assertNumQueries(3):
+            self.client.get("/admin/stregsystem/report/sales_api")
+        self.assertEqual(before, self.reports())
+
+    def test_refund_is_removed_from_rollup(self):
+        with freeze_time(self.now):
+            rollup_sales()
+        before = self.reports()
+
+        Sale.objects.filter(product=self.beer, timestamp__gt=self.now - datetime.timedelta(days=6)).first().delete()
+        after = self.reports()
+
+        self.assertEqual(before[0] - self.beer.price, after[0])
+
+    def test_grouped_refund_is_removed_from_rollup(self):
+        with freeze_time(self.now):
+            rollup_sales()
+
+        Sale.refund(
+            Sale.objects.filter(timestamp__gt=self.now - datetime.timedelta(days=21)),
+            User.objects.get(username="tester"),
+        )
+
+        refunded = set(DailySales.objects.values_list('date', 'product', 'room', 'count', 'revenue'))
+        with freeze_time(self.now):
+            rollup_sales(since=datetime.date(2021, 2, 1))
+        rebuilt = set(DailySales.objects.values_list('date', 'product', 'room', 'count', 'revenue'))
+        self.assertEqual(rebuilt, {row for row in refunded if row[3] != 0})
+
+    def test_rollup_since(self):
+        with freeze_time(self.now):
+            rollup_sales()
+        DailySales.objects.filter(date__gte=datetime.date(2021, 3, 1)).update(count=0)
+
+        with freeze_time(self.now):
+            call_command('rollupsales', '--since=2021-03-01', stdout=StringIO())
+
+        self.assertEqual(1, DailySales.objects.get(date=datetime.date(2021, 3, 10)).count)
+
+    def test_rollup_since_not_a_date(self):
+        with self.assertRaisesMessage(CommandError, "'2021-03' is not a date"):
+            call_command('rollupsales', '--since=2021-03', stdout=StringIO())
+
+
+class MemberDeleteTests(TransactionTestCase):
+    # The foreign keys are only checked at commit, so this can't be a TestCase
+
+    def setUp(self):
+        self.room = Room.objects.create(name="room")
+        self.beer = Product.objects.create(name="øl", price=600, active=True)
+        RankGroup.objects.create(name="Øl", position=0).products.add(self.beer)
+        self.day = fjule_party(2018) + datetime.timedelta(days=30)
+
+    def member_with_sales(self, username, count):
+        member = Member.objects.create(username=username, balance=100000)
+        with freeze_time(self.day):
+            for _ in range(count):
+                Sale.objects.create(member=member, product=self.beer, room=self.room, price=self.beer.price)
+        return member
+
+    def delete_queries(self, member):
+        with CaptureQueriesContext(connection) as context:
+            member.delete()
+        return len(context.captured_queries)
+
+    def test_delete_member_in_ranks(self):
+        jan = self.member_with_sales("jan", 2)
+        jokke = self.member_with_sales("jokke", 1)
+        update_ranks(2019)
+
+        jan.delete()
+
+        self.assertEqual({jokke.id}, set(RankEntry.objects.values_list("member_id", flat=True)))
+        self.assertFalse(Sale.objects.filter(member_id=jan.id).exists())
+
+    def test_delete_member_queries_constant(self):
+        few = self.member_with_sales("few", 2)
+        many = self.member_with_sales("many", 20)
+        update_ranks(2019)
+        rollup_sales()
+
+        self.assertEqual(self.delete_queries(few), self.delete_queries(many))
+
+
+class CategoryReportTests(TestCase):
+    fixtures = ["initial_data"]
+
+    def setUp(self):
+        self.client.login(username="tester", password="treotreo")
+        self.jan = Member.objects.get(username="jan")
+        self.jokke = Member.objects.get(username="jokke")
+        self.beer = Product.objects.get(id=1)
+        self.milk = Product.objects.get(id=2)
+        self.drinks = Category.objects.create(name="Drikkevarer")
+        self.alcohol = Category.objects.create(name="Alkohol")
+        self.dairy = Category.objects.create(name="Mejeri")
+        self.beer.categories.add(self.drinks, self.alcohol)
+        self.milk.categories.add(self.drinks, self.dairy)
+        for member, product, count in [
+            (self.jan, self.beer, 3),
+            (self.jokke, self.milk, 2),
+            (self.jokke, self.beer, 1),
+        ]:
+            for _ in range(count):
+                Sale.objects.create(member=member, product=product, price=product.price)
+
+    def report(self, categories, **kwargs):
+        response = self.client.post(
+            "/admin/stregsystem/report/categories/", {"categories": [c.id for c in categories]}, **kwargs
+        )
+        self.assertEqual(200, response.status_code)
+        return response
+
+    def test_report(self):
+        response = self.report([self.drinks, self.alcohol, self.dairy])
+
+        self.assertEqual(["Drikkevarer", "Alkohol", "Mejeri"], list(response.context["header"]))
+        self.assertEqual(
+            # jokke has bought a milk in the fixture
+            [("jokke", 8, [4, 1, 3]), ("jan", 6, [3, 3, 0])],
+            list(response.context["data"]),
+        )
+
+    def test_report_queries_dont_depend_on_categories(self):
+        with CaptureQueriesContext(connection) as one:
+            self.report([self.dairy])
+        with CaptureQueriesContext(connection) as three:
+            self.report([self.drinks, self.alcohol, self.dairy])
+
+        self.assertEqual(len(one.captured_queries), len(three.captured_queries))
+
+    @patch('stregreport.views.CATEGORY_REPORT_PAGE_SIZE', 1)
+    def test_report_pages(self):
+        response = self.report([self.drinks])
+        self.assertEqual([("jokke", 4, [4])], list(response.context["data"]))
+        self.assertContains(response, f"?categories={self.drinks.id}&amp;page=2")
+
+        response = self.client.get("/admin/stregsystem/report/categories/", {"categories": self.drinks.id, "page": 2})
+
+        self.assertEqual([("jan", 3, [3])], list(response.context["data"]))
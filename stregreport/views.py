@@ -4,6 +4,7 @@ from functools import reduce
 import pytz
 from django.contrib.admin.views.decorators import staff_member_required
 from django.contrib.auth.decorators import permission_required
+from django.core.paginator import Paginator
 from django.db.models import Count, Q, Sum
 from django.db.models.functions import TruncDay
 from django.forms import fields
@@ -11,10 +12,13 @@ from django.forms.widgets import SelectDateWidget
 from django.http import JsonResponse
 from django.shortcuts import redirect, render, get_object_or_404
 from django.urls import reverse
+from django.utils.http import urlencode
 from django.utils import dateparse, timezone
 from stregreport.forms import CategoryReportForm
 from stregsystem.models import Category, Member, Product, Sale
-from stregreport.models import BreadRazzia, RazziaEntry
+from stregreport.models import BreadRazzia, DailySales, RazziaEntry
+from stregreport.ranks import fjule_party, year_ranks
+from stregreport.rollups import split_period
 from stregsystem.templatetags.stregsystem_extras import money
 
 
@@ -54,7 +58,7 @@ def razzia(request, razzia_id, razzia_type=BreadRazzia.BREAD, title=None):
 def razzia_view_single(request, razzia_id, queryname, razzia_type=BreadRazzia.BREAD, title=None):
     razzia = get_object_or_404(BreadRazzia, pk=razzia_id, razzia_type=razzia_type)
     if queryname is not None:
-        result = list(Member.objects.filter(username__iexact=queryname))
+        result = list(Member.with_username(queryname))
         if len(result) > 0:
             member = result[0]
             entries = list(razzia.razziaentry_set.filter(member__pk=member.pk).order_by('-time'))
@@ -104,7 +108,7 @@ razzia_members = staff_member_required(razzia_members)
 def _sales_to_user_in_period(username, start_date, end_date, product_list, product_dict):
     result = (
         Product.objects.filter(
-            sale__member__username__iexact=username,
+            sale__member__in=Member.with_username(username),
             id__in=product_list,
             sale__timestamp__gte=start_date,
             sale__timestamp__lte=end_date,
@@ -138,7 +142,7 @@ def razzia_view(request):
         return render(request, 'admin/stregsystem/razzia/error_wizarderror.html', {})
 
     try:
-        user = Member.objects.get(username__iexact=username)
+        user = Member.with_username(username).get()
     except (Member.DoesNotExist, Member.MultipleObjectsReturned):
         return render(
             request,
@@ -243,14 +247,24 @@ def sales_product(request, ids, from_time, to_time, error=None):
     sales = []
     if ids is not None and len(ids) > 0:
         products = reduce(lambda a, b: a + str(b) + ' ', ids, '')
-        query = reduce(lambda x, y: x | y, [Q(id=z) for z in ids])
-        query &= Q(sale__timestamp__gt=from_date_time_tz_aware)
-        query &= Q(sale__timestamp__lte=to_date_time_tz_aware)
-        result = Product.objects.filter(query).annotate(Count('sale'), Sum('sale__price'))
+        days, rest = split_period(from_date_time_tz_aware, to_date_time_tz_aware)
+        result = {}
+        for r in Product.objects.filter(Q(id__in=ids) & rest('sale__')).annotate(Count('sale'), Sum('sale__price')):
+            result[r.pk] = r
+        if days is not None:
+            rolled_up = Product.objects.filter(id__in=ids, dailysales__date__range=days).annotate(
+                count=Sum('dailysales__count'), revenue=Sum('dailysales__revenue')
+            )
+            for r in rolled_up:
+                if r.pk not in result:
+                    result[r.pk] = r
+                    r.sale__count = r.sale__price__sum = 0
+                result[r.pk].sale__count += r.count
+                result[r.pk].sale__price__sum += r.revenue
 
         count = 0
         sum = 0
-        for r in result:
+        for r in sorted(result.values(), key=lambda r: r.pk):
             sales.append((r.pk, r.name, r.sale__count, money(r.sale__price__sum)))
             count = count + r.sale__count
             sum = sum + r.sale__price__sum
@@ -266,53 +280,11 @@ def sales_product(request, ids, from_time, to_time, error=None):
 def ranks_for_year(request, year):
     if year <= 1900 or year > 9999:
         return render(request, 'admin/stregsystem/report/error_ranksnotfound.html', locals())
-    milk = [2, 3, 4, 5, 6, 7, 8, 9, 10, 16, 17, 18, 19, 20, 24, 25, 43, 44, 45, 1865]
-    caffeine = [11, 12, 30, 34, 37, 1787, 1790, 1791, 1795, 1799, 1800, 1803, 1804, 1837, 1864]
-    beer = [
-        13,
-        14,
-        29,
-        42,
-        47,
-        54,
-        65,
-        66,
-        1773,
-        1776,
-        1777,
-        1779,
-        1780,
-        1783,
-        1793,
-        1794,
-        1807,
-        1808,
-        1809,
-        1820,
-        1822,
-        1840,
-        1844,
-        1846,
-        1847,
-        1853,
-        1855,
-        1856,
-        1858,
-        1859,
-    ]
-    coffee = [32, 35, 36, 39]
-    vitamin = [1850, 1851, 1852, 1863]
-
     FORMAT = '%d/%m/%Y kl. %H:%M'
     last_year = year - 1
     from_time = fjule_party(year - 1)
     to_time = fjule_party(year)
-    kr_stat_list = sale_money_rank(from_time, to_time)
-    beer_stat_list = sale_product_rank(beer, from_time, to_time)
-    caffeine_stat_list = sale_product_rank(caffeine, from_time, to_time)
-    milk_stat_list = sale_product_rank(milk, from_time, to_time)
-    coffee_stat_list = sale_product_rank(coffee, from_time, to_time)
-    vitamin_stat_list = sale_product_rank(vitamin, from_time, to_time)
+    group_stat_lists, kr_stat_list = year_ranks(year)
     from_time_string = from_time.strftime(FORMAT)
     to_time_string = to_time.strftime(FORMAT)
     current_date = timezone.now()
@@ -320,28 +292,6 @@ def ranks_for_year(request, year):
     return render(request, 'admin/stregsystem/report/ranks.html', locals())
 
 
-# gives a list of member objects, with the additional field sale__count, with the number of sales which are in the parameter id
-def sale_product_rank(ids, from_time, to_time, rank_limit=10):
-    stat_list = (
-        Member.objects.filter(sale__timestamp__gt=from_time, sale__timestamp__lte=to_time, sale__product__in=ids)
-        .annotate(Count('sale'))
-        .order_by('-sale__count', 'username')[:rank_limit]
-    )
-    return stat_list
-
-
-# gives a list of member object, with the additional field sale__price__sum__formatted which is the number of money spent in the period given.
-def sale_money_rank(from_time, to_time, rank_limit=10):
-    stat_list = (
-        Member.objects.filter(active=True, sale__timestamp__gt=from_time, sale__timestamp__lte=to_time)
-        .annotate(Sum('sale__price'))
-        .order_by('-sale__price__sum', 'username')[:rank_limit]
-    )
-    for member in stat_list:
-        member.sale__price__sum__formatted = money(member.sale__price__sum)
-    return stat_list
-
-
 # year of the last fjuleparty
 def last_fjule_party_year():
     current_date = timezone.now()
@@ -360,14 +310,6 @@ def next_fjule_party_year():
     return current_date.year + 1
 
 
-# date of fjuleparty (first friday of december) for the given year at
-# 10 o'clock
-def fjule_party(year):
-    first_december = timezone.datetime(year, 12, 1, 22, tzinfo=pytz.timezone("Europe/Copenhagen"))
-    days_to_add = (11 - first_december.weekday()) % 7
-    return first_december + datetime.timedelta(days=days_to_add)
-
-
 def parse_id_string(id_string):
     try:
         return list(map(int, id_string.split(' ')))
@@ -394,26 +336,50 @@ def daily(request):
     startTime_day = timezone.now() - datetime.timedelta(hours=24)
     revenue_day = (Sale.objects.filter(timestamp__gt=startTime_day).aggregate(Sum("price"))["price__sum"]) or 0.0
     startTime_month = timezone.now() - datetime.timedelta(days=30)
-    revenue_month = (Sale.objects.filter(timestamp__gt=startTime_month).aggregate(Sum("price"))["price__sum"]) or 0.0
-    top_month_category = (
-        Category.objects.filter(product__sale__timestamp__gt=startTime_month)
-        .annotate(sale=Count("product__sale"))
-        .order_by("-sale")[:7]
-    )
+    # whole days which have been rolled up are read from the daily totals
+    days, rest = split_period(startTime_month, timezone.now())
+    revenue_month = Sale.objects.filter(rest()).aggregate(Sum("price"))["price__sum"] or 0
+    month_categories = {
+        c.pk: c for c in Category.objects.filter(rest('product__sale__')).annotate(sale=Count("product__sale"))
+    }
+    if days is not None:
+        revenue_month += DailySales.objects.filter(date__range=days).aggregate(Sum("revenue"))["revenue__sum"] or 0
+        rolled_up = Category.objects.filter(product__dailysales__date__range=days).annotate(
+            sale=Sum("product__dailysales__count")
+        )
+        for c in rolled_up:
+            if c.pk in month_categories:
+                month_categories[c.pk].sale += c.sale
+            else:
+                month_categories[c.pk] = c
+    revenue_month = revenue_month or 0.0
+    top_month_category = sorted(month_categories.values(), key=lambda c: -c.sale)[:7]
 
     return render(request, 'admin/stregsystem/report/daily.html', locals())
 
 
 def sales_api(request):
     startTime_month = timezone.now() - datetime.timedelta(days=30)
+    # whole days which have been rolled up are read from the daily totals
+    days, rest = split_period(startTime_month, timezone.now())
     qs = (
-        Sale.objects.filter(timestamp__gt=startTime_month)
+        Sale.objects.filter(rest())
         .annotate(day=TruncDay('timestamp'))
         .values('day')
         .annotate(c=Count('*'))
         .annotate(r=Sum('price'))
     )
-    db_sales = {i["day"].date(): (i["c"], money(i["r"])) for i in qs}
+    totals = {i["day"].date(): (i["c"], i["r"]) for i in qs}
+    if days is not None:
+        rolled_up = (
+            DailySales.objects.filter(date__range=days)
+            .values('date')
+            .annotate(c=Sum('count'))
+            .annotate(r=Sum('revenue'))
+        )
+        for i in rolled_up:
+            totals[i["date"]] = (i["c"], i["r"])
+    db_sales = {day: (c, money(r)) for day, (c, r) in totals.items()}
     base = timezone.now().date()
     date_list = [base - datetime.timedelta(days=x) for x in range(0, 30)]
 
@@ -439,61 +405,49 @@ def sales_api(request):
 daily = staff_member_required(daily)
 
 
+# Members shown per page of the category report
+CATEGORY_REPORT_PAGE_SIZE = 100
+
+
+def _purchases_in_categories(categories):
+    """
+    Counts the purchases of every member in each of the categories, with a
+    single grouped query. Returns (username, total, counts) for every member,
+    with the counts in the order of categories, the biggest buyers first.
+    """
+    position = {category.id: index for index, category in enumerate(categories)}
+    counts_of_member = {}
+    for member_id, username, category_id, count in (
+        Sale.objects.filter(product__categories__in=categories)
+        .values_list('member_id', 'member__username', 'product__categories')
+        .annotate(Count('id'))
+        .order_by()
+    ):
+        if member_id not in counts_of_member:
+            counts_of_member[member_id] = (username, [0] * len(categories))
+        counts_of_member[member_id][1][position[category_id]] = count
+
+    data = [(username, sum(counts), counts) for username, counts in counts_of_member.values()]
+    data.sort(key=lambda row: (-row[1], row[0]))
+    return data
+
+
 @permission_required("stregsystem.access_sales_reports")
 def user_purchases_in_categories(request):
     form = CategoryReportForm()
     data = None
     header = None
-    if request.method == 'POST':
-        form = CategoryReportForm(request.POST)
+    query = None
+    # The first page is posted from the form, the pages after it are linked
+    # to with the categories in the query string
+    if request.method == 'POST' or 'categories' in request.GET:
+        form = CategoryReportForm(request.POST if request.method == 'POST' else request.GET)
         if form.is_valid():
-            categories = form.cleaned_data['categories']
-
-            # @SPEED: This is not a good solution for maximum speed,
-            # however neither is using MySQL. Django doesn't want to
-            # group by category_id correctly.
-            # -- Troels 2017-10-04
-
-            user_sales_per_category = {}
-            for c in categories:
-                user_sales_per_category_q = (
-                    Member.objects.filter(sale__product__categories=c)
-                    .annotate(sales=Count("*"))
-                    .order_by("sale__product__categories")
-                    .values_list(
-                        "id",
-                        "sales",
-                        "sale__product__categories__name",
-                    )
-                )
-
-                for user_id, sale_count, category_name in user_sales_per_category_q:
-                    if user_id not in user_sales_per_category:
-                        user_sales_per_category[user_id] = {}
-                    user_sales_per_category[user_id][category_name] = sale_count
-
-            users = (
-                Member.objects.filter(sale__product__categories__in=categories)
-                .annotate(total_sales=Count("*"))
-                .order_by("-total_sales")
-                .values_list(
-                    "id",
-                    "username",
-                    "total_sales",
-                )
-            )
-
-            header = categories.values_list("name", flat=True)
-            data = []
-            for user_id, username, total_sales in users:
-                category_assoc = []
-                for h in header:
-                    this_sales = user_sales_per_category[user_id]
-                    if h in this_sales:
-                        category_assoc.append(this_sales[h])
-                    else:
-                        category_assoc.append(0)
-                data.append((username, total_sales, category_assoc))
+            categories = list(form.cleaned_data['categories'])
+            header = [category.name for category in categories]
+            paginator = Paginator(_purchases_in_categories(categories), CATEGORY_REPORT_PAGE_SIZE)
+            data = paginator.get_page(request.GET.get('page'))
+            query = urlencode([('categories', category.id) for category in categories])
 
     return render(
         request,
@@ -502,5 +456,6 @@ def user_purchases_in_categories(request):
             "form": form,
             "data": data,
             "header": header,
+            "query": query,
         },
     )
@@ -3,10 +3,26 @@ from django import forms
 from django.contrib.admin.views.autocomplete import AutocompleteJsonView
 from django.contrib import messages
 from django.contrib.admin.models import LogEntry
-
-from stregsystem.models import Category, Member, News, Payment, PayTransaction, Product, Room, Sale, MobilePayment
+from django.db.models import Case, Exists, OuterRef, Value, When
+
+from stregsystem.caches import invalidate_productlist
+from stregsystem.models import (
+    Category,
+    Member,
+    News,
+    Payment,
+    PayTransaction,
+    Product,
+    Room,
+    Sale,
+    MobilePayment,
+)
 from stregsystem.templatetags.stregsystem_extras import money
-from stregsystem.utils import make_active_productlist_query, make_inactive_productlist_query
+from stregsystem.utils import (
+    annotate_product_activated,
+    make_active_productlist_query,
+    make_inactive_productlist_query,
+)
 
 
 class SaleAdmin(admin.ModelAdmin):
@@ -19,6 +35,9 @@ class SaleAdmin(admin.ModelAdmin):
         'timestamp',
         'get_price_display',
     )
+    list_select_related = ('member', 'product', 'room')
+    # Counting every sale for the "x total" link is a full table scan
+    show_full_result_count = False
     actions = ['refund']
     search_fields = ['^member__username', '=product__id', 'product__name']
     valid_lookups = 'member'
@@ -52,17 +71,14 @@ class SaleAdmin(admin.ModelAdmin):
     get_room_name.admin_order_field = "room__name"
 
     def delete_model(self, request, obj):
-        transaction = PayTransaction(obj.price)
-        obj.member.rollback(transaction)
-        obj.member.save()
+        obj.member.revert_transaction(PayTransaction(obj.price))
         super(SaleAdmin, self).delete_model(request, obj)
+        invalidate_productlist()
 
     def save_model(self, request, obj, form, change):
         if change:
             return
-        transaction = PayTransaction(obj.price)
-        obj.member.fulfill(transaction)
-        obj.member.save()
+        obj.member.apply_transaction(PayTransaction(obj.price))
         super(SaleAdmin, self).save_model(request, obj, form, change)
 
     def get_price_display(self, obj):
@@ -74,23 +90,20 @@ class SaleAdmin(admin.ModelAdmin):
     get_price_display.admin_order_field = "price"
 
     def refund(modeladmin, request, queryset):
-        for obj in queryset:
-            transaction = PayTransaction(obj.price)
-            obj.member.rollback(transaction)
-            obj.member.save()
-        queryset.delete()
+        Sale.refund(queryset, request.user)
 
     refund.short_description = "Refund selected"
 
 
 def toggle_active_selected_products(modeladmin, request, queryset):
     "toggles active on products, also removes deactivation date."
-    # This is horrible since it does not use update, but update will
-    # not do not F('active') so we are doing this. I am sorry.
-    for obj in queryset:
-        obj.deactivate_date = None
-        obj.active = not obj.active
-        obj.save()
+    # The prices don't change, so there is no need to go through
+    # Product.save, which looks at the price history of every product
+    queryset.update(active=Case(When(active=True, then=Value(False)), default=Value(True)), deactivate_date=None)
+    invalidate_productlist()
+
+
+toggle_active_selected_products.short_description = "Toggle Active"
 
 
 class ProductActivatedListFilter(admin.SimpleListFilter):
@@ -144,15 +157,21 @@ class ProductAdmin(admin.ModelAdmin):
     get_price_display.admin_order_field = "price"
 
     def get_bought(self, obj):
-        return obj.bought
+        if obj.start_date is None:
+            return 0
+        return obj.bought_count
 
     get_bought.short_description = "Bought"
-    get_bought.admin_order_field = "bought"
+    get_bought.admin_order_field = "bought_count"
+
+    def get_queryset(self, request):
+        return annotate_product_activated(super().get_queryset(request))
 
     def activated(self, product):
-        return product.is_active()
+        return product.activated
 
     activated.boolean = True
+    activated.admin_order_field = 'activated'
 
 
 class CategoryAdmin(admin.ModelAdmin):
@@ -225,6 +244,7 @@ class MemberAdmin(admin.ModelAdmin):
 
 class PaymentAdmin(admin.ModelAdmin):
     list_display = ('get_username', 'timestamp', 'get_amount_display', 'is_mobilepayment')
+    list_select_related = ('member',)
     valid_lookups = 'member'
     search_fields = ['member__username']
     autocomplete_fields = ['member']
@@ -232,6 +252,13 @@ class PaymentAdmin(admin.ModelAdmin):
     class Media:
         css = {'all': ('stregsystem/select2-stregsystem.css',)}
 
+    def get_queryset(self, request):
+        return (
+            super()
+            .get_queryset(request)
+            .annotate(from_mobilepayment=Exists(MobilePayment.objects.filter(payment=OuterRef('pk'))))
+        )
+
     def get_username(self, obj):
         return obj.member.username
 
@@ -245,7 +272,7 @@ class PaymentAdmin(admin.ModelAdmin):
     get_amount_display.admin_order_field = "amount"
 
     def is_mobilepayment(self, obj):
-        return MobilePayment.objects.filter(payment=obj.pk).exists()
+        return obj.from_mobilepayment
 
     is_mobilepayment.short_description = "From MobilePayment"
     is_mobilepayment.admin_order_field = "from_mobilepayment"
@@ -262,6 +289,8 @@ class MobilePaymentAdmin(admin.ModelAdmin):
         'get_amount_display',
         'status',
     )
+    # The payment is shown with the username of its member
+    list_select_related = ('payment__member',)
     valid_lookups = 'member'
     search_fields = ['member__username']
     autocomplete_fields = ['member', 'payment']
@@ -295,6 +324,7 @@ class LogEntryAdmin(admin.ModelAdmin):
     list_filter = ['content_type', 'action_flag']
     search_fields = ['object_repr', 'change_message', 'user__username']
     list_display = ['action_time', 'user', 'content_type', 'object_id', 'action_flag', 'change_message', 'object_repr']
+    list_select_related = ('user', 'content_type')
 
     def has_view_permission(self, request, obj=None):
         return request.user.is_superuser
@@ -1,13 +1,33 @@
 from django.apps import AppConfig
 
-from django.db.models.signals import post_save
-from stregsystem.signals import after_member_save
+from django.db.models.signals import m2m_changed, post_delete, post_save, pre_delete
+from stregsystem.signals import (
+    after_member_save,
+    after_sale_delete,
+    after_sales_cascade,
+    before_sales_cascade,
+    sales_refunded,
+)
 
 
 class StregConfig(AppConfig):
     name = 'stregsystem'
 
     def ready(self):
-        from stregsystem.models import Member
+        from stregsystem import balances
+        from stregsystem.caches import after_product_change
+        from stregsystem.models import Member, Payment, Product, Room, Sale
 
         post_save.connect(after_member_save, sender=Member)
+
+        post_delete.connect(after_sale_delete, sender=Sale)
+        for model in [Member, Product, Room]:
+            pre_delete.connect(before_sales_cascade, sender=model)
+            post_delete.connect(after_sales_cascade, sender=model)
+        post_delete.connect(balances.after_payment_delete, sender=Payment)
+        sales_refunded.connect(balances.after_sales_refund, sender=Sale)
+
+        post_save.connect(after_product_change, sender=Product)
+        post_delete.connect(after_product_change, sender=Product)
+        m2m_changed.connect(after_product_change, sender=Product.rooms.through)
+        m2m_changed.connect(after_product_change, sender=Product.categories.through)
@@ -0,0 +1,170 @@
+import datetime
+from collections import defaultdict
+from typing import NamedTuple
+
+from django.db import transaction
+from django.db.models import Case, F, IntegerField, Max, OuterRef, Subquery, Sum, Value, When
+from django.db.models.functions import Coalesce
+from django.utils import timezone
+
+from stregsystem.models import BalanceCheckpoint, Member, MemberBalance, Payment, Sale
+
+# Payments and sales are only put in a checkpoint once they are this old. Ids
+# are handed out before the rows are committed, so a row with a lower id may
+# show up after one with a higher id.
+BALANCE_SETTLE_TIME = datetime.timedelta(minutes=1)
+
+# How many checkpoints to keep, the older ones are deleted
+BALANCE_CHECKPOINTS_KEPT = 30
+
+# How many members to recheck in one statement
+BALANCE_RECHECK_BATCH_SIZE = 500
+
+
+class BalanceDrift(NamedTuple):
+    member: Member
+    expected: int
+
+    @property
+    def drift(self):
+        return self.member.balance - self.expected
+
+
+def _latest_checkpoint():
+    try:
+        return BalanceCheckpoint.objects.latest()
+    except BalanceCheckpoint.DoesNotExist:
+        return None
+
+
+def _expected_balances(checkpoint, last_payment_id=None, last_sale_id=None):
+    """
+    The balance of every member with a history, according to the checkpoint
+    and the payments and sales after it, up to the given ids if given.
+    """
+    balances = defaultdict(int)
+    payments, sales = Payment.objects.all(), Sale.objects.all()
+    if checkpoint is not None:
+        balances.update(MemberBalance.objects.filter(checkpoint=checkpoint).values_list('member_id', 'balance'))
+        payments = payments.filter(id__gt=checkpoint.last_payment_id)
+        sales = sales.filter(id__gt=checkpoint.last_sale_id)
+    if last_payment_id is not None:
+        payments = payments.filter(id__lte=last_payment_id)
+    if last_sale_id is not None:
+        sales = sales.filter(id__lte=last_sale_id)
+
+    for member_id, amount in payments.values_list('member_id').annotate(Sum('amount')).order_by():
+        balances[member_id] += amount
+    for member_id, price in sales.values_list('member_id').annotate(Sum('price')).order_by():
+        balances[member_id] -= price
+    return balances
+
+
+def _settled_id(queryset, last_id, settled_time):
+    settled_id = queryset.filter(id__gt=last_id, timestamp__lte=settled_time).aggregate(Max('id'))['id__max']
+    return last_id if settled_id is None else settled_id
+
+
+@transaction.atomic
+def make_balance_checkpoint():
+    """
+    Makes a new checkpoint from the latest one and the payments and sales
+    made since. Returns the new checkpoint.
+    """
+    previous = _latest_checkpoint()
+    settled_time = timezone.now() - BALANCE_SETTLE_TIME
+    checkpoint = BalanceCheckpoint.objects.create(
+        last_payment_id=_settled_id(Payment.objects, previous.last_payment_id if previous else 0, settled_time),
+        last_sale_id=_settled_id(Sale.objects, previous.last_sale_id if previous else 0, settled_time),
+    )
+    balances = _expected_balances(previous, checkpoint.last_payment_id, checkpoint.last_sale_id)
+    MemberBalance.objects.bulk_create(
+        MemberBalance(checkpoint=checkpoint, member_id=member_id, balance=balance)
+        for member_id, balance in balances.items()
+    )
+
+    old = BalanceCheckpoint.objects.order_by('-id').values_list('id', flat=True)[BALANCE_CHECKPOINTS_KEPT:]
+    BalanceCheckpoint.objects.filter(id__in=list(old)).delete()
+    return checkpoint
+
+
+def _recheck(checkpoint, member_ids):
+    """
+    The members among member_ids whose balance doesn't match their history,
+    annotated with the expected balance. Everything is read in one statement,
+    so sales and payments being made meanwhile can't show up as drift.
+    """
+
+    def total(queryset, field):
+        return Coalesce(
+            Subquery(
+                queryset.filter(member=OuterRef('pk')).values('member').annotate(total=Sum(field)).values('total'),
+                output_field=IntegerField(),
+            ),
+            Value(0),
+        )
+
+    payments, sales = Payment.objects.all(), Sale.objects.all()
+    checkpoint_balance = Value(0, output_field=IntegerField())
+    if checkpoint is not None:
+        payments = payments.filter(id__gt=checkpoint.last_payment_id)
+        sales = sales.filter(id__gt=checkpoint.last_sale_id)
+        checkpoint_balance = total(MemberBalance.objects.filter(checkpoint=checkpoint), 'balance')
+
+    return (
+        Member.objects.filter(pk__in=member_ids)
+        .annotate(expected=checkpoint_balance + total(payments, 'amount') - total(sales, 'price'))
+        .exclude(balance=F('expected'))
+        .order_by('username')
+    )
+
+
+def verify_balances():
+    """
+    Compares the balance of every member to the latest checkpoint plus the
+    payments and sales made since. Returns a BalanceDrift for every member
+    whose balance doesn't match.
+    """
+    checkpoint = _latest_checkpoint()
+    expected = _expected_balances(checkpoint)
+    candidates = [
+        member_id
+        for member_id, balance in Member.objects.values_list('id', 'balance')
+        if balance != expected.get(member_id, 0)
+    ]
+    return [
+        BalanceDrift(member, member.expected)
+        for start in range(0, len(candidates), BALANCE_RECHECK_BATCH_SIZE)
+        for member in _recheck(checkpoint, candidates[start : start + BALANCE_RECHECK_BATCH_SIZE])
+    ]
+
+
+def after_sales_refund(sender, sales, **kwargs):
+    """
+    Gives refunded sales back in the checkpoints which include them. The
+    checkpoints getting the same amounts back are updated together.
+    """
+    checkpoints_of_totals = defaultdict(list)
+    for checkpoint_id, last_sale_id in BalanceCheckpoint.objects.filter(
+        last_sale_id__gte=min(sale.id for sale in sales)
+    ).values_list('id', 'last_sale_id'):
+        totals = defaultdict(int)
+        for sale in sales:
+            if sale.id <= last_sale_id:
+                totals[sale.member_id] += sale.price
+        checkpoints_of_totals[tuple(sorted(totals.items()))].append(checkpoint_id)
+
+    for totals, checkpoint_ids in checkpoints_of_totals.items():
+        MemberBalance.objects.filter(checkpoint_id__in=checkpoint_ids, member_id__in=dict(totals)).update(
+            balance=F('balance')
+            + Case(*[When(member_id=pk, then=Value(total)) for pk, total in totals], output_field=IntegerField())
+        )
+
+
+def after_payment_delete(sender, instance, **kwargs):
+    """
+    Takes a deleted payment out of the checkpoints which include it.
+    """
+    MemberBalance.objects.filter(checkpoint__last_payment_id__gte=instance.id, member_id=instance.member_id).update(
+        balance=F('balance') - instance.amount
+    )
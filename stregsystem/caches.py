@@ -0,0 +1,71 @@
+import math
+
+from django.core.cache import cache
+from django.db import transaction
+from django.utils import timezone
+
+from stregsystem.utils import make_active_productlist_query, make_room_specific_query
+
+# Upper bound for how long a product list may be served from the cache. The
+# changes we know about invalidate the cache explicitly, but with the default
+# local memory cache that only reaches the process making the change. The
+# other processes keep serving their list until it expires, so keep it short.
+PRODUCTLIST_CACHE_TIMEOUT = 5
+
+_PRODUCTLIST_GENERATION_KEY = 'stregsystem:productlist:generation'
+
+
+def _productlist_generation():
+    return cache.get_or_set(_PRODUCTLIST_GENERATION_KEY, 0, None)
+
+
+def _productlist_key(room_id):
+    return f'stregsystem:productlist:{_productlist_generation()}:{int(room_id)}'
+
+
+def _productlist_timeout(product_list):
+    """
+    The list has to be recomputed when the first of its products passes its
+    deactivate_date, so never cache it for longer than that.
+    """
+    now = timezone.now()
+    timeout = PRODUCTLIST_CACHE_TIMEOUT
+    for product in product_list:
+        if product.deactivate_date is not None:
+            timeout = min(timeout, (product.deactivate_date - now).total_seconds())
+    return max(1, math.ceil(timeout))
+
+
+def get_active_productlist(room_id):
+    """
+    Returns the list of products which can be bought in the given room.
+    """
+    from stregsystem.models import Product  # import locally to avoid circular import
+
+    key = _productlist_key(room_id)
+    product_list = cache.get(key)
+    if product_list is None:
+        product_list = list(make_active_productlist_query(Product.objects).filter(make_room_specific_query(room_id)))
+        cache.set(key, product_list, _productlist_timeout(product_list))
+    return product_list
+
+
+def _bump_productlist_generation():
+    cache.add(_PRODUCTLIST_GENERATION_KEY, 0, None)
+    cache.incr(_PRODUCTLIST_GENERATION_KEY)
+
+
+def invalidate_productlist():
+    """
+    Drops the cached product lists for all rooms. Bumping the generation is
+    enough, the old entries will just expire.
+
+    This is done right away, and again once the current transaction commits,
+    so no other connection can cache the list as it was before the change.
+    """
+    _bump_productlist_generation()
+    transaction.on_commit(_bump_productlist_generation)
+
+
+def after_product_change(sender, **kwargs):
+    invalidate_productlist()
@@ -1,3 +1,4 @@
+import datetime
 import smtplib
 import logging
 
@@ -6,19 +7,88 @@ from email.mime.multipart import MIMEMultipart
 from email.mime.text import MIMEText
 from .utils import money
 from django.conf import settings
-
+from django.utils import timezone
 
 logger = logging.getLogger(__name__)
 
+MAIL_SENDER = 'treo@fklub.dk'
+# A mail is given up on after this many failed attempts, the time between
+# attempts doubles every time, up to the maximum
+MAIL_MAX_ATTEMPTS = 10
+MAIL_RETRY_DELAY = datetime.timedelta(minutes=1)
+MAIL_MAX_RETRY_DELAY = datetime.timedelta(hours=6)
+# A mail is claimed by the run sending it for this long, so runs overlapping
+# it leave the mail alone. If the run dies, the mail is sent again after this.
+MAIL_CLAIM_TIME = datetime.timedelta(minutes=10)
+
 
 def send_email(mailadress, msg_string):
-    if hasattr(settings, 'TEST_MODE'):
+    """
+    Queues a mail for the sendqueuedmail command. The mail is written in
+    the current transaction, so it is only sent if the transaction commits.
+    """
+    from stregsystem.models import QueuedMail  # import locally to avoid circular import
+
+    if not mailadress:
         return
+    QueuedMail.objects.create(recipient=mailadress, message=msg_string)
+
+
+def _retry_delay(attempts):
+    return min(MAIL_RETRY_DELAY * 2 ** (attempts - 1), MAIL_MAX_RETRY_DELAY)
+
+
+def send_queued_mail(limit=None):
+    """
+    Sends the queued mails which are due, over a single SMTP connection.
+    Mails which fail are retried later, with backoff. Each mail is claimed
+    before it is sent, so overlapping runs don't send the same mail twice.
+    Returns the number of mails sent and failed.
+    """
+    from stregsystem.models import QueuedMail  # import locally to avoid circular import
+
+    due = QueuedMail.objects.filter(attempts__lt=MAIL_MAX_ATTEMPTS, next_attempt__lte=timezone.now()).order_by(
+        'next_attempt', 'id'
+    )
+    sent, failed = 0, 0
+    smtp = None
     try:
-        smtpObj = smtplib.SMTP('localhost', 25)
-        smtpObj.sendmail('treo@fklub.dk', mailadress, msg_string)
-    except Exception as e:
-        logger.error(str(e))
+        for mail in due[:limit]:
+            # Another run may have claimed the mail since it was fetched
+            claimed_until = timezone.now() + MAIL_CLAIM_TIME
+            if not QueuedMail.objects.filter(pk=mail.pk, next_attempt=mail.next_attempt).update(
+                next_attempt=claimed_until
+            ):
+                continue
+            try:
+                if smtp is None:
+                    smtp = smtplib.SMTP(settings.EMAIL_HOST, settings.EMAIL_PORT, timeout=settings.EMAIL_TIMEOUT or 60)
+                smtp.sendmail(MAIL_SENDER, [mail.recipient], mail.message)
+            except (smtplib.SMTPException, OSError) as e:
+                logger.error(f"Could not send mail to {mail.recipient}: {e}")
+                if not isinstance(e, (smtplib.SMTPRecipientsRefused, smtplib.SMTPDataError, smtplib.SMTPSenderRefused)):
+                    # The connection is broken, open a new one for the next mail
+                    smtp = _close(smtp)
+                mail.attempts += 1
+                mail.next_attempt = timezone.now() + _retry_delay(mail.attempts)
+                mail.last_error = str(e)
+                mail.save(update_fields=['attempts', 'next_attempt', 'last_error'])
+                failed += 1
+            else:
+                mail.delete()
+                sent += 1
+    finally:
+        _close(smtp)
+    return sent, failed
+
+
+def _close(smtp):
+    if smtp is not None:
+        try:
+            smtp.quit()
+        except (smtplib.SMTPException, OSError):
+            smtp.close()
+    return None
 
 
 def send_welcome_mail(member):
@@ -0,0 +1,29 @@
+from django.core.management import BaseCommand
+from django.db import transaction
+
+from stregsystem.models import OldPrice
+
+# How many rows to delete in one statement
+DELETE_BATCH_SIZE = 500
+
+
+class Command(BaseCommand):
+    help = "Delete the rows of the price history which repeat the price before them"
+
+    @transaction.atomic
+    def handle(self, *args, **options):
+        redundant = []
+        last_product_id, last_price = None, None
+        for old_price_id, product_id, price in (
+            OldPrice.objects.order_by('product_id', 'changed_on', 'id')
+            .values_list('id', 'product_id', 'price')
+            .iterator()
+        ):
+            if product_id == last_product_id and price == last_price:
+                redundant.append(old_price_id)
+            last_product_id, last_price = product_id, price
+
+        for start in range(0, len(redundant), DELETE_BATCH_SIZE):
+            OldPrice.objects.filter(id__in=redundant[start : start + DELETE_BATCH_SIZE]).delete()
+
+        self.stdout.write(self.style.SUCCESS(f'[compactoldprices] Deleted {len(redundant)} redundant old prices'))
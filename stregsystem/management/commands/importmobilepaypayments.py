@@ -10,7 +10,7 @@ import json
 import logging
 import requests
 
-from stregsystem.utils import mobile_payment_exact_match_member, strip_emoji
+from stregsystem.utils import mobile_payment_exact_match_members, strip_emoji
 
 
 class Command(BaseCommand):
@@ -24,19 +24,43 @@ class Command(BaseCommand):
 
     logger = logging.getLogger(__name__)
     days_back = None
+    session = None
+    fetch_time = None
+
+    # The import continues from when the API was last fetched, which is kept
+    # in the token storage. Transactions can show up in the API a while after
+    # their timestamp, so look this much further back by default, the overlap
+    # is skipped as duplicates.
+    cursor_overlap = timedelta(hours=6)
+    max_days_back = 31
 
     def add_arguments(self, parser):
         parser.add_argument(
             'days_back',
             nargs='?',
             type=int,
-            default=7,
-            help="Days back from today to look for MobilePay transactions (max 31 days)",
+            default=None,
+            help="Days back from today to look for MobilePay transactions (max 31 days). "
+            "Defaults to continuing from the last import, or 7 days",
+        )
+        parser.add_argument(
+            '--overlap-hours',
+            type=float,
+            default=None,
+            help="Hours before the last import to continue from, to catch transactions reported late. "
+            f"Defaults to {self.cursor_overlap.total_seconds() / 3600:g}",
         )
 
     def handle(self, *args, **options):
-        self.days_back = options['days_back'] if options['days_back'] <= 31 else 7
-        self.import_mobilepay_payments()
+        if options['days_back'] is not None:
+            self.days_back = options['days_back'] if options['days_back'] <= self.max_days_back else 7
+        if options['overlap_hours'] is not None:
+            self.cursor_overlap = timedelta(hours=options['overlap_hours'])
+        self.session = requests.Session()
+        try:
+            self.import_mobilepay_payments()
+        finally:
+            self.session.close()
 
     def write_debug(self, s):
         self.logger.debug(s)
@@ -70,7 +94,7 @@ class Command(BaseCommand):
             "client_id": self.tokens['zip-client-id'],
             "client_secret": self.tokens['zip-client-secret'],
         }
-        response = requests.post(url, data=payload)
+        response = self.session.post(url, data=payload)
         response.raise_for_status()
         json_response = response.json()
         # Calculate when the token expires
@@ -85,12 +109,23 @@ class Command(BaseCommand):
     def format_datetime(inputdatetime):
         return f"{inputdatetime.strftime('%Y-%m-%dT%H:%M:%S.%f')[:-3]}Z"
 
-    # Fetches the transactions for a given payment-point (MobilePay phone-number) in a given period (from-to)
+    # The start of the period to fetch transactions from
+    def get_from_time(self, current_time):
+        if self.days_back is None and self.tokens.get('transactions_cursor'):
+            from_time = (
+                parse_datetime(self.tokens['transactions_cursor']).astimezone(timezone.utc) - self.cursor_overlap
+            )
+            return max(from_time, current_time - timedelta(days=self.max_days_back))
+        return current_time - timedelta(days=7 if self.days_back is None else self.days_back)
+
+    # Fetches the transactions for a given payment-point (MobilePay phone-number) in a given period (from-to),
+    # following the pages of the result
     def get_transactions(self):
         url = f"{self.api_endpoint}/transaction-reporting/api/merchant/v1/paymentpoints/{self.tokens['paymentpoint']}/transactions"
         current_time = datetime.now(timezone.utc)
+        self.fetch_time = current_time
         params = {
-            'from': self.format_datetime(current_time - timedelta(days=self.days_back)),
+            'from': self.format_datetime(self.get_from_time(current_time)),
             'to': self.format_datetime(current_time),
         }
         headers = {
@@ -98,9 +133,22 @@ class Command(BaseCommand):
             'x-ibm-client-id': self.tokens['ibm-client-id'],
             'authorization': 'Bearer {}'.format(self.tokens['access_token']),
         }
-        response = requests.get(url, params=params, headers=headers)
-        response.raise_for_status()
-        return response.json()['transactions']
+        transactions = []
+        while url:
+            response = self.session.get(url, params=params, headers=headers)
+            response.raise_for_status()
+            json_response = response.json()
+            transactions.extend(json_response['transactions'])
+            # The next page link already contains the query
+            url, params = json_response.get('nextPageLink'), None
+            if url and url.startswith('/'):
+                url = f"{self.api_endpoint}{url}"
+        return transactions
+
+    # Remembers when the API was fetched, so the next import can continue from there
+    def update_cursor(self):
+        self.tokens['transactions_cursor'] = self.fetch_time.isoformat()
+        self.update_token_storage()
 
     # Client side check if the token has expired.
     def refresh_expired_token(self):
@@ -113,7 +161,6 @@ class Command(BaseCommand):
         # Do a client side check if token is good. If not - fetch another token.
         try:
             self.refresh_expired_token()
-            assert self.days_back is not None
             return self.get_transactions()
         except HTTPError as e:
             self.write_error(f"Got an HTTP error when trying to fetch transactions: {e.response}")
@@ -127,39 +174,56 @@ class Command(BaseCommand):
             self.write_info(f'Ran, but no transactions found')
             return
 
-        for transaction in transactions:
-            self.import_mobilepay_payment(transaction)
+        self.import_mobilepay_payment_batch(transactions)
+        self.update_cursor()
 
         self.write_info('Successfully ran MobilePayment API import')
 
-    def import_mobilepay_payment(self, transaction):
-        if transaction['type'] != 'Payment':
-            return
-
-        trans_id = transaction['paymentTransactionId']
-
-        if MobilePayment.objects.filter(transaction_id=trans_id).exists():
-            self.write_debug(f'Skipping transaction since it already exists (Transaction ID: {trans_id})')
-            return
-
-        currency_code = transaction['currencyCode']
-        if currency_code != 'DKK':
-            self.write_warning(f'Does ONLY support DKK (Transaction ID: {trans_id}), was {currency_code}')
-            return
-
-        amount = transaction['amount']
-
-        comment = strip_emoji(transaction['senderComment'])
-
-        payment_datetime = parse_datetime(transaction['timestamp'])
-
-        MobilePayment.objects.create(
-            amount=amount * 100,  # convert to streg-ører
-            member=mobile_payment_exact_match_member(comment),
-            comment=comment,
-            timestamp=payment_datetime,
-            transaction_id=trans_id,
-            status=MobilePayment.UNSET,
+    def import_mobilepay_payment_batch(self, transactions):
+        payments = [transaction for transaction in transactions if transaction['type'] == 'Payment']
+        existing = set(
+            MobilePayment.objects.filter(
+                transaction_id__in={transaction['paymentTransactionId'] for transaction in payments}
+            ).values_list('transaction_id', flat=True)
         )
 
-        self.write_info(f'Imported transaction id: {trans_id} for amount: {amount}')
+        mobile_payments = []
+        for transaction in payments:
+            trans_id = transaction['paymentTransactionId']
+
+            if trans_id in existing:
+                self.write_debug(f'Skipping transaction since it already exists (Transaction ID: {trans_id})')
+                continue
+
+            currency_code = transaction['currencyCode']
+            if currency_code != 'DKK':
+                self.write_warning(f'Does ONLY support DKK (Transaction ID: {trans_id}), was {currency_code}')
+                continue
+
+            existing.add(trans_id)
+            amount = transaction['amount']
+
+            comment = strip_emoji(transaction['senderComment'])
+
+            payment_datetime = parse_datetime(transaction['timestamp'])
+
+            mobile_payments.append(
+                (
+                    MobilePayment(
+                        amount=amount * 100,  # convert to streg-ører
+                        comment=comment,
+                        timestamp=payment_datetime,
+                        transaction_id=trans_id,
+                        status=MobilePayment.UNSET,
+                    ),
+                    amount,
+                )
+            )
+
+        members = mobile_payment_exact_match_members(mobile_payment.comment for mobile_payment, _ in mobile_payments)
+        for mobile_payment, _ in mobile_payments:
+            mobile_payment.member = members.get(mobile_payment.comment)
+        MobilePayment.objects.bulk_create(mobile_payment for mobile_payment, _ in mobile_payments)
+
+        for mobile_payment, amount in mobile_payments:
+            self.write_info(f'Imported transaction id: {mobile_payment.transaction_id} for amount: {amount}')
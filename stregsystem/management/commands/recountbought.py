@@ -0,0 +1,22 @@
+from django.core.management import BaseCommand
+
+from stregsystem.models import Product
+
+
+class Command(BaseCommand):
+    help = "Rebuild the bought counters of limited products from the sale history"
+
+    def handle(self, *args, **options):
+        count = 0
+        for product in Product.objects.filter(start_date__isnull=False):
+            before = product.bought_count
+            product.recount_bought()
+            if product.bought_count != before:
+                self.stdout.write(
+                    self.style.WARNING(
+                        f'[recountbought] {product.name} ({product.id}) was {before}, is {product.bought_count}'
+                    )
+                )
+            count += 1
+
+        self.stdout.write(self.style.SUCCESS(f'[recountbought] Recounted {count} limited products'))
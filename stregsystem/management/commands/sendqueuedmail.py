@@ -0,0 +1,18 @@
+from django.core.management import BaseCommand
+
+from stregsystem.mail import send_queued_mail
+
+
+class Command(BaseCommand):
+    help = "Send the queued mails which are due, retrying the ones that failed earlier"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--limit', type=int, help="Send at most this many mails")
+
+    def handle(self, *args, **options):
+        sent, failed = send_queued_mail(limit=options['limit'])
+
+        if failed:
+            self.stdout.write(self.style.WARNING(f'[sendqueuedmail] Sent {sent} mails, {failed} failed'))
+        else:
+            self.stdout.write(self.style.SUCCESS(f'[sendqueuedmail] Sent {sent} mails'))
@@ -0,0 +1,33 @@
+from django.core.management import BaseCommand
+
+from stregsystem.balances import make_balance_checkpoint, verify_balances
+from stregsystem.templatetags.stregsystem_extras import money
+
+
+class Command(BaseCommand):
+    help = "Verify the balance of every member against their payments and sales since the latest checkpoint"
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--checkpoint',
+            action='store_true',
+            help="Make a new checkpoint after verifying, so the next verification starts from there",
+        )
+
+    def handle(self, *args, **options):
+        drifts = verify_balances()
+        for drift in drifts:
+            self.stdout.write(
+                self.style.WARNING(
+                    f'[verifybalances] {drift.member.username} ({drift.member.id}) has {money(drift.member.balance)}, '
+                    f'expected {money(drift.expected)} (drift {money(drift.drift)})'
+                )
+            )
+        if drifts:
+            self.stdout.write(self.style.WARNING(f'[verifybalances] {len(drifts)} balances have drifted'))
+        else:
+            self.stdout.write(self.style.SUCCESS('[verifybalances] All balances match'))
+
+        if options['checkpoint']:
+            checkpoint = make_balance_checkpoint()
+            self.stdout.write(self.style.SUCCESS(f'[verifybalances] Made checkpoint {checkpoint.id}'))
@@ -0,0 +1,29 @@
+from django.db import migrations, models
+from django.utils import timezone
+
+
+def count_bought(apps, schema_editor):
+    Product = apps.get_model('stregsystem', 'Product')
+    Sale = apps.get_model('stregsystem', 'Sale')
+    for product in Product.objects.filter(start_date__isnull=False):
+        midnight = timezone.make_aware(
+            timezone.datetime(product.start_date.year, product.start_date.month, product.start_date.day, 0, 0)
+        )
+        bought_count = Sale.objects.filter(product=product, timestamp__gt=midnight).count()
+        Product.objects.filter(pk=product.pk).update(bought_count=bought_count)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('stregsystem', '0014_mobilepayment_nullable_customername_20210908_1522'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='product',
+            name='bought_count',
+            field=models.IntegerField(default=0, editable=False),
+        ),
+        migrations.RunPython(count_bought, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,23 @@
+# Generated by Django 2.2.24 on 2026-10-18 18:03
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('stregsystem', '0015_product_bought_count'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='member',
+            name='bac',
+            field=models.FloatField(default=0.0, editable=False),
+        ),
+        migrations.AddField(
+            model_name='member',
+            name='bac_timestamp',
+            field=models.DateTimeField(blank=True, editable=False, null=True),
+        ),
+    ]
@@ -0,0 +1,17 @@
+from django.db import migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('stregsystem', '0017_queuedmail'),
+    ]
+
+    operations = [
+        # Django can't declare an index on an expression yet, see
+        # Member.with_username for the lookups using it
+        migrations.RunSQL(
+            'CREATE INDEX stregsystem_member_username_lower ON stregsystem_member (lower(username))',
+            'DROP INDEX stregsystem_member_username_lower',
+        ),
+    ]
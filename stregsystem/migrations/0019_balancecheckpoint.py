@@ -0,0 +1,38 @@
+# Generated by Django 2.2.24 on 2026-10-18 18:22
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('stregsystem', '0018_member_username_lower_index'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='BalanceCheckpoint',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('created', models.DateTimeField(auto_now_add=True)),
+                ('last_payment_id', models.IntegerField()),
+                ('last_sale_id', models.IntegerField()),
+            ],
+            options={
+                'get_latest_by': 'id',
+            },
+        ),
+        migrations.CreateModel(
+            name='MemberBalance',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('balance', models.IntegerField()),
+                ('checkpoint', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='stregsystem.BalanceCheckpoint')),
+                ('member', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='stregsystem.Member')),
+            ],
+            options={
+                'unique_together': {('checkpoint', 'member')},
+            },
+        ),
+    ]
@@ -0,0 +1,17 @@
+# Generated by Django 2.2.24 on 2026-10-18 18:30
+
+from django.db import migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('stregsystem', '0019_balancecheckpoint'),
+    ]
+
+    operations = [
+        migrations.AlterIndexTogether(
+            name='oldprice',
+            index_together={('product', 'changed_on')},
+        ),
+    ]
@@ -1,14 +1,18 @@
-from collections import Counter
+from bisect import bisect_right
+from collections import Counter, defaultdict
 from email.utils import parseaddr
 
-from django.contrib.admin.models import LogEntry, ADDITION, CHANGE
+from django.contrib.admin.models import LogEntry, ADDITION, CHANGE, DELETION
 from django.contrib.auth.models import User
 from django.contrib.contenttypes.models import ContentType
-from django.db import models, transaction
-from django.db.models import Count
+from django.db import connection, models, transaction
+from django.db.models import Case, F, IntegerField, Q, Value, When, prefetch_related_objects
+from django.db.models.functions import Lower
 from django.utils import timezone
 
+from stregsystem.caches import invalidate_productlist
 from stregsystem.deprecated import deprecated
+from stregsystem.signals import refunding_sales, sales_refunded
 from stregsystem.templatetags.stregsystem_extras import money
 from stregsystem.utils import (
     date_to_midnight,
@@ -114,26 +118,43 @@ class Order(object):
     def execute(self):
         transaction = PayTransaction(amount=self.total())
 
-        # Check if we have enough inventory to fulfill the order
-        for item in self.items:
-            if item.product.start_date is not None and (item.product.bought + item.count > item.product.quantity):
-                raise NoMoreInventoryError()
+        # Reserve the inventory needed to fulfill the order. This is done in
+        # product id order, so two orders can't deadlock each other.
+        limited_items = sorted(
+            (item for item in self.items if item.product.start_date is not None), key=lambda item: item.product.id
+        )
+        now = timezone.now()
+        for item in limited_items:
+            reserve_bought(item.product.id, item.count, now)
 
         # Take update lock on member row
         self.member = Member.objects.select_for_update().get(id=self.member.id)
         self.member.fulfill(transaction)
 
-        for item in self.items:
-            # @HACK Since we want to use the old database layout, we need to
-            # add a sale for every item and every instance of that item
-            for i in range(item.count):
-                s = Sale(member=self.member, product=item.product, room=self.room, price=item.product.price)
-                s.save()
+        # @HACK Since we want to use the old database layout, we need to
+        # add a sale for every item and every instance of that item. They are
+        # all written in a single insert to keep the member lock short.
+        sales = [
+            Sale(member=self.member, product=item.product, room=self.room, price=item.product.price)
+            for item in self.items
+            for _ in range(item.count)
+        ]
+        Sale.objects.bulk_create(sales)
+
+        alcohol_ml = sum(
+            item.product.alcohol_content_ml * item.count for item in self.items if item.product.alcohol_content_ml
+        )
+        if alcohol_ml > 0:
+            self.member.drink(alcohol_ml, timezone.now())
+
+        # The sales were counted towards bought when we reserved them. If we
+        # just sold the last of something, it has to go from the product lists.
+        limited_ids = [item.product.id for item in limited_items]
+        if limited_ids and Product.objects.filter(pk__in=limited_ids, bought_count__gte=F('quantity')).exists():
+            invalidate_productlist()
 
-            # Bought (used above) is automatically calculated, so we don't need
-            # to update it
         # We changed the user balance, so save that
-        self.member.save()
+        self.member.save(update_fields=['balance', 'bac', 'bac_timestamp'])
 
 
 class GetTransaction(MoneyTransaction):
@@ -167,6 +188,10 @@ class Member(models.Model):  # id automatisk...
     balance = models.IntegerField(default=0)  # hvor mange oerer vedkommende har til gode
     undo_count = models.IntegerField(default=0)  # for 'undos' i alt
     notes = models.TextField(blank=True)
+    # Blood alcohol content as of bac_timestamp, see calculate_alcohol_promille.
+    # A bac_timestamp of None means it has to be computed from the sales.
+    bac = models.FloatField(default=0.0, editable=False)
+    bac_timestamp = models.DateTimeField(null=True, blank=True, editable=False)
 
     stregforbud_override = False
 
@@ -198,6 +223,42 @@ class Member(models.Model):  # id automatisk...
             + ")"
         )
 
+    @staticmethod
+    def with_username(username, exact=False):
+        """
+        The members with the given username, compared case insensitively
+        unless exact is given. Goes through the index on lower(username),
+        which username__iexact can't use.
+        """
+        members = Member.objects.annotate(username_lower=Lower('username')).filter(
+            username_lower=Lower(Value(username, output_field=models.CharField()))
+        )
+        if exact:
+            members = members.filter(username=username)
+        return members
+
+    @staticmethod
+    def with_usernames(usernames):
+        """
+        The members with any of the given usernames, compared case
+        insensitively like with_username. Each member is annotated with its
+        username_lower.
+        """
+        return Member.objects.annotate(username_lower=Lower('username')).filter(
+            username_lower__in=[Lower(Value(username, output_field=models.CharField())) for username in set(usernames)]
+        )
+
+    def save(self, *args, **kwargs):
+        if not self._state.adding and 'update_fields' not in kwargs:
+            # The BAC is advanced by Order.execute, never write back a stale
+            # copy of it
+            kwargs['update_fields'] = [
+                field.name
+                for field in self._meta.concrete_fields
+                if not field.primary_key and field.name not in ('bac', 'bac_timestamp')
+            ]
+        super(Member, self).save(*args, **kwargs)
+
     # XXX - virker ikke
     #    def get_absolute_url(self):
     #        return "/stregsystem/1/user/%i/" % self.id
@@ -229,6 +290,46 @@ class Member(models.Model):  # id automatisk...
         """
         self.balance -= transaction.change()
 
+    def apply_payment(self, amount):
+        """
+        Adds amount to the balance in the database, with a single UPDATE so
+        changes made through other instances of the member aren't lost.
+        """
+        Member.objects.filter(pk=self.pk).update(balance=F('balance') + amount)
+        self.make_payment(amount)
+
+    def apply_transaction(self, transaction):
+        """
+        Fulfills the transaction in the database, with a single UPDATE which
+        only goes through if the balance in the database can fulfill it.
+        """
+        change = transaction.change()
+        members = Member.objects.filter(pk=self.pk)
+        if change < 0:
+            members = members.filter(balance__gte=-change)
+        if not members.update(balance=F('balance') + change):
+            raise StregForbudError
+        self.balance += change
+
+    @staticmethod
+    def apply_payments(totals):
+        """
+        Adds the amounts in totals, a dict from member ids to amounts, to the
+        balances in the database with a single UPDATE.
+        """
+        if totals:
+            Member.objects.filter(pk__in=totals).update(
+                balance=F('balance')
+                + Case(*[When(pk=pk, then=Value(total)) for pk, total in totals.items()], output_field=IntegerField())
+            )
+
+    def revert_transaction(self, transaction):
+        """
+        Rolls the transaction back in the database, like apply_payment.
+        """
+        Member.objects.filter(pk=self.pk).update(balance=F('balance') - transaction.change())
+        self.rollback(transaction)
+
     def can_fulfill(self, transaction):
         """
         Can the member fulfill the transaction
@@ -253,27 +354,59 @@ class Member(models.Model):  # id automatisk...
 
         return self.balance - buy < 0
 
-    # BAC in this method stands for "Blood alcohol content"
-    def calculate_alcohol_promille(self):
-        from stregsystem.booze import alcohol_bac_timeline, Gender
+    def _booze_gender(self):
+        from stregsystem.booze import Gender
+
+        if self.gender == "M":
+            return Gender.MALE
+        elif self.gender == "F":
+            return Gender.FEMALE
+        return Gender.UNKNOWN
+
+    def _calculate_bac_from_sales(self, now):
+        from stregsystem.booze import alcohol_bac_timeline
         from datetime import timedelta
 
-        now = timezone.now()
         # Lets assume noone is drinking 12 hours straight
         calculation_start = now - timedelta(hours=12)
 
-        alcohol_sales = self.sale_set.filter(
-            timestamp__gt=calculation_start, product__alcohol_content_ml__gt=0.0
-        ).order_by('timestamp')
-        alcohol_timeline = [(s.timestamp, s.product.alcohol_content_ml) for s in alcohol_sales]
+        alcohol_timeline = list(
+            self.sale_set.filter(timestamp__gt=calculation_start, product__alcohol_content_ml__gt=0.0)
+            .order_by('timestamp')
+            .values_list('timestamp', 'product__alcohol_content_ml')
+        )
 
-        gender = Gender.UNKNOWN
-        if self.gender == "M":
-            gender = Gender.MALE
-        elif self.gender == "F":
-            gender = Gender.FEMALE
+        return alcohol_bac_timeline(self._booze_gender(), 80, now, alcohol_timeline)
+
+    def drink(self, alcohol_ml, timestamp):
+        """
+        Advances the stored BAC with alcohol_ml drunk at timestamp. The sales
+        must already be saved, and the caller is responsible for saving the
+        member.
+        """
+        from stregsystem.booze import alcohol_bac_degradation, alcohol_bac_increase
 
-        bac = alcohol_bac_timeline(gender, 80, now, alcohol_timeline)
+        if self.bac_timestamp is None or self.bac_timestamp > timestamp:
+            # We don't know where we were, so start over from the sales, which
+            # include this drink
+            self.bac = self._calculate_bac_from_sales(timestamp)
+        else:
+            current = max(0.0, self.bac - alcohol_bac_degradation(timestamp - self.bac_timestamp))
+            self.bac = current + alcohol_bac_increase(self._booze_gender(), 80, alcohol_ml)
+        self.bac_timestamp = timestamp
+
+    # BAC in this method stands for "Blood alcohol content"
+    def calculate_alcohol_promille(self):
+        from stregsystem.booze import alcohol_bac_degradation
+
+        now = timezone.now()
+
+        # Someone else may have updated the BAC since we were loaded
+        bac, bac_timestamp = Member.objects.filter(pk=self.pk).values_list('bac', 'bac_timestamp').get()
+        if bac_timestamp is None or bac_timestamp > now:
+            bac = self._calculate_bac_from_sales(now)
+        else:
+            bac = max(0.0, bac - alcohol_bac_degradation(now - bac_timestamp))
 
         # Tihi:
         drunken_bastards = {
@@ -311,34 +444,50 @@ class Payment(models.Model):  # id automatisk...
     def __str__(self):
         return self.member.username + " " + str(self.timestamp) + ": " + money(self.amount)
 
+    @transaction.atomic
     def save(self, *args, **kwargs):
         if self.id:
             return  # update -- should not be allowed
         else:
-            # TODO: Make atomic
-            self.member.make_payment(self.amount)
             super(Payment, self).save(*args, **kwargs)
-            self.member.save()
-            if self.member.email != "" and self.amount != 0:
-                if '@' in parseaddr(self.member.email)[1] and self.member.want_spam:
-                    send_payment_mail(self.member, self.amount)
+            self.member.apply_payment(self.amount)
+            self.mail_member()
+
+    def mail_member(self):
+        if self.member.email != "" and self.amount != 0:
+            if '@' in parseaddr(self.member.email)[1] and self.member.want_spam:
+                send_payment_mail(self.member, self.amount)
+
+    @staticmethod
+    def bulk_create_applied(payments):
+        """
+        Inserts payments whose amounts have already been added to the
+        balances of their members. Unlike save() this doesn't touch the
+        members, and it doesn't send any mails.
+        """
+        if connection.features.can_return_ids_from_bulk_insert:
+            Payment.objects.bulk_create(payments)
+        else:
+            # We need the ids, and this database can't return them from a
+            # bulk insert
+            for payment in payments:
+                super(Payment, payment).save()
 
-    def log_from_mobile_payment(self, processed_mobile_payment, admin_user: User):
-        LogEntry.objects.log_action(
+    def log_entry_from_mobile_payment(self, processed_mobile_payment, admin_user: User):
+        return LogEntry(
             user_id=admin_user.pk,
             content_type_id=ContentType.objects.get_for_model(Payment).pk,
-            object_id=self.id,
-            object_repr=str(self),
+            object_id=str(self.id),
+            object_repr=str(self)[:200],
             action_flag=ADDITION,
             change_message=f"{''}" f"MobilePayment (transaction_id: {processed_mobile_payment.transaction_id})",
         )
 
+    @transaction.atomic
     def delete(self, *args, **kwargs):
         if self.id:
-            # TODO: Make atomic
-            self.member.make_payment(-self.amount)
+            self.member.apply_payment(-self.amount)
             super(Payment, self).delete(*args, **kwargs)
-            self.member.save()
         else:
             super(Payment, self).delete(*args, **kwargs)
 
@@ -380,29 +529,24 @@ class MobilePayment(models.Model):
     @transaction.atomic()
     def delete(self, *args, **kwargs):
         if self.id and self.payment is not None:
-            self.member.make_payment(-self.amount)
-            super(MobilePayment, self).delete(*args, **kwargs)
-            self.member.save()
+            # Takes the payment back from the member, and deletes this along
+            # with it, so the payments still add up to the balance
+            self.payment.delete(*args, **kwargs)
         else:
             super(MobilePayment, self).delete(*args, **kwargs)
 
     @staticmethod
     @transaction.atomic
     def submit_processed_mobile_payments(admin_user: User):
+        approved, ignored = [], []
         processed_mobile_payment: MobilePayment  # annotate iterated variable (PEP 526)
-        for processed_mobile_payment in make_processed_mobilepayment_query():
-
+        for processed_mobile_payment in make_processed_mobilepayment_query().select_related('member'):
             if processed_mobile_payment.status == MobilePayment.APPROVED:
-                payment = Payment(member=processed_mobile_payment.member, amount=processed_mobile_payment.amount)
-                # Save payment and foreign key to MobilePayment field
-                payment.save()
-                payment.log_from_mobile_payment(processed_mobile_payment, admin_user)
-                processed_mobile_payment.log_mobile_payment(admin_user, "Approved")
-                processed_mobile_payment.payment = payment
-                processed_mobile_payment.save()
-
+                approved.append(processed_mobile_payment)
             elif processed_mobile_payment.status == MobilePayment.IGNORED:
-                processed_mobile_payment.log_mobile_payment(admin_user, "Ignored")
+                ignored.append(processed_mobile_payment)
+
+        MobilePayment.settle(approved, ignored, admin_user)
 
     @staticmethod
     @transaction.atomic
@@ -438,36 +582,63 @@ class MobilePayment(models.Model):
                 )
             )
 
+        mobile_payments = MobilePayment.objects.select_related('member').in_bulk(mobile_payment_ids)
+        approved, ignored = [], []
         for row in cleaned_data:
-            processed_mobile_payment = MobilePayment.objects.get(id=row['id'].id)
+            processed_mobile_payment = mobile_payments[row['id'].id]
+            processed_mobile_payment.status = row['status']
             # If approved, we need to create a payment and relate said payment to the mobilepayment.
             if row['status'] == MobilePayment.APPROVED:
-                payment_amount = processed_mobile_payment.amount
-                member = Member.objects.get(id=row['member'].id)
-
-                payment = Payment(member=member, amount=payment_amount)
-                payment.log_from_mobile_payment(processed_mobile_payment, admin_user)
-                payment.save()
-
-                processed_mobile_payment.payment = payment
-                processed_mobile_payment.member = member
-                processed_mobile_payment.log_mobile_payment(admin_user, "Approved")
+                processed_mobile_payment.member_id = row['member'].id
+                approved.append(processed_mobile_payment)
             # If ignored, we need to log who did it.
             elif row['status'] == MobilePayment.IGNORED:
-                processed_mobile_payment.log_mobile_payment(admin_user, "Ignored")
+                ignored.append(processed_mobile_payment)
 
-            processed_mobile_payment.status = row['status']
-            processed_mobile_payment.save()
+        MobilePayment.settle(approved, ignored, admin_user)
 
         # Return how many records were modified.
         return len(mobile_payment_ids)
 
-    def log_mobile_payment(self, admin_user: User, msg):
-        LogEntry.objects.log_action(
+    @staticmethod
+    def settle(approved, ignored, admin_user: User):
+        """
+        Creates the payments of the approved MobilePayments, and saves and
+        logs all of them, with a constant number of queries. Each member's
+        balance is updated once, no matter how many payments they have. The
+        payment mails are queued, and sent once the transaction commits.
+        """
+        totals = defaultdict(int)
+        for mobile_payment in approved:
+            totals[mobile_payment.member_id] += mobile_payment.amount
+        Member.apply_payments(totals)
+        members = Member.objects.in_bulk(totals)
+
+        payments = [
+            Payment(member=members[mobile_payment.member_id], amount=mobile_payment.amount)
+            for mobile_payment in approved
+        ]
+        Payment.bulk_create_applied(payments)
+        for mobile_payment, payment in zip(approved, payments):
+            mobile_payment.member = payment.member
+            mobile_payment.payment = payment
+            payment.mail_member()
+        MobilePayment.objects.bulk_update(approved + ignored, ['member', 'payment', 'status'])
+
+        log_entries = []
+        for mobile_payment, payment in zip(approved, payments):
+            log_entries.append(payment.log_entry_from_mobile_payment(mobile_payment, admin_user))
+            log_entries.append(mobile_payment.log_entry(admin_user, "Approved"))
+        for mobile_payment in ignored:
+            log_entries.append(mobile_payment.log_entry(admin_user, "Ignored"))
+        LogEntry.objects.bulk_create(log_entries)
+
+    def log_entry(self, admin_user: User, msg):
+        return LogEntry(
             user_id=admin_user.pk,
             content_type_id=ContentType.objects.get_for_model(MobilePayment).pk,
-            object_id=self.id,
-            object_repr=str(self),
+            object_id=str(self.id),
+            object_repr=str(self)[:200],
             action_flag=CHANGE,
             change_message=msg,
         )
@@ -475,10 +646,7 @@ class MobilePayment(models.Model):
     @staticmethod
     @transaction.atomic
     def approve_member_filled_mobile_payments():
-        for payment in make_unprocessed_member_filled_mobilepayment_query():
-            if payment.status == MobilePayment.UNSET:
-                payment.status = MobilePayment.APPROVED
-                payment.save()
+        make_unprocessed_member_filled_mobilepayment_query().update(status=MobilePayment.APPROVED)
 
 
 class Category(models.Model):
@@ -517,6 +685,9 @@ class Product(models.Model):  # id automatisk...
     categories = models.ManyToManyField(Category, blank=True)
     rooms = models.ManyToManyField(Room, blank=True)
     alcohol_content_ml = models.FloatField(default=0.0, null=True)
+    # Number of sales since start_date. Only maintained for limited products,
+    # and only ever changed with update queries. See Product.bought
+    bought_count = models.IntegerField(default=0, editable=False)
 
     @deprecated
     def __unicode__(self):
@@ -525,17 +696,47 @@ class Product(models.Model):  # id automatisk...
     def __str__(self):
         return active_str(self.active) + " " + self.name + " (" + money(self.price) + ")"
 
+    @classmethod
+    def from_db(cls, db, field_names, values):
+        instance = super(Product, cls).from_db(db, field_names, values)
+        # Remember what we loaded, so save can tell what changed
+        instance._loaded_values = dict(zip(field_names, values))
+        return instance
+
     def save(self, *args, **kwargs):
-        price_changed = True
-        if self.id:
-            try:
-                oldprice = self.old_prices.order_by('-changed_on')[0:1].get()
-                price_changed = oldprice != self.price
-            except OldPrice.DoesNotExist:  # der findes varer hvor der ikke er nogen "tidligere priser"
-                pass
+        adding = self._state.adding
+        loaded_values = getattr(self, '_loaded_values', {})
+        # The price history gets a new row when the price differs from the
+        # one we loaded. Products we didn't load always get one.
+        price_changed = 'price' not in loaded_values or loaded_values['price'] != self.price
+        start_date_changed = 'start_date' not in loaded_values or loaded_values['start_date'] != self.start_date
+        if not adding and 'update_fields' not in kwargs:
+            # Sales update the bought counter concurrently, so never write back
+            # our copy of it
+            kwargs['update_fields'] = [
+                field.name
+                for field in self._meta.concrete_fields
+                if not field.primary_key and field.name != 'bought_count'
+            ]
         super(Product, self).save(*args, **kwargs)
         if price_changed:
             OldPrice.objects.create(product=self, price=self.price)
+        if not adding and start_date_changed:
+            self.recount_bought()
+        self._loaded_values = {field.attname: getattr(self, field.attname) for field in self._meta.concrete_fields}
+
+    @transaction.atomic
+    def recount_bought(self):
+        """
+        Recomputes the bought counter from the sale history.
+        """
+        # Lock the product, so no sale can update the counter while we count
+        Product.objects.select_for_update().only('pk').get(pk=self.pk)
+        bought_count = 0
+        if self.start_date is not None:
+            bought_count = self.sale_set.filter(timestamp__gt=date_to_midnight(self.start_date)).count()
+        Product.objects.filter(pk=self.pk).update(bought_count=bought_count)
+        self.bought_count = bought_count
 
     @property
     def bought(self):
@@ -543,9 +744,33 @@ class Product(models.Model):  # id automatisk...
         # bought count - Jesper 27/09-2017
         if self.start_date is None:
             return 0
-        return self.sale_set.filter(timestamp__gt=date_to_midnight(self.start_date)).aggregate(bought=Count("id"))[
-            "bought"
-        ]
+        if self.pk is None:
+            return self.bought_count
+        # Sales update the counter in the database, so read it from there
+        # instead of trusting the copy we have loaded
+        return Product.objects.filter(pk=self.pk).values_list('bought_count', flat=True).get()
+
+    def price_at(self, timestamp):
+        """
+        The price of the product at the given time, according to the price
+        history, or None if the time is before the history.
+        """
+        return (
+            self.old_prices.filter(changed_on__lte=timestamp)
+            .order_by('-changed_on', '-id')
+            .values_list('price', flat=True)
+            .first()
+        )
+
+    @staticmethod
+    def prices_at(lookups):
+        """
+        Does price_at for every (product_id, timestamp) in lookups, with a
+        single query. Returns the prices in the same order.
+        """
+        lookups = list(lookups)
+        history = PriceHistory({product_id for product_id, _ in lookups})
+        return [history.price_at(product_id, timestamp) for product_id, timestamp in lookups]
 
     def is_active(self):
         expired = self.deactivate_date is not None and self.deactivate_date <= timezone.now()
@@ -564,6 +789,11 @@ class OldPrice(models.Model):  # gamle priser, skal huskes; til regnskab/statist
     price = models.IntegerField()  # penge, oere...
     changed_on = models.DateTimeField(auto_now_add=True)
 
+    class Meta:
+        index_together = [
+            ["product", "changed_on"],
+        ]
+
     @deprecated
     def __unicode__(self):
         return self.__str__()
@@ -572,6 +802,36 @@ class OldPrice(models.Model):  # gamle priser, skal huskes; til regnskab/statist
         return self.product.name + ": " + money(self.price) + " (" + str(self.changed_on) + ")"
 
 
+class PriceHistory(object):
+    """
+    The price histories of the given products, or of all products, loaded
+    with a single query. The price of the products at any point in time can
+    then be looked up without further queries.
+    """
+
+    def __init__(self, product_ids=None):
+        self._changes = {}
+        old_prices = OldPrice.objects.order_by('product_id', 'changed_on', 'id')
+        if product_ids is not None:
+            old_prices = old_prices.filter(product_id__in=product_ids)
+        for product_id, changed_on, price in old_prices.values_list('product_id', 'changed_on', 'price').iterator():
+            timestamps, prices = self._changes.setdefault(product_id, ([], []))
+            timestamps.append(changed_on)
+            prices.append(price)
+
+    def price_at(self, product_id, timestamp):
+        """
+        The price of the product at the given time, or None if the time is
+        before its price history.
+        """
+        timestamps, prices = self._changes.get(product_id, ((), ()))
+        # The last change at or before the timestamp
+        index = bisect_right(timestamps, timestamp)
+        if index == 0:
+            return None
+        return prices[index - 1]
+
+
 class Sale(models.Model):
     member = models.ForeignKey(Member, on_delete=models.CASCADE)
     product = models.ForeignKey(Product, on_delete=models.CASCADE)
@@ -604,13 +864,121 @@ class Sale(models.Model):
         if self.id:
             raise RuntimeError("Updates of sales are not allowed")
         super(Sale, self).save(*args, **kwargs)
+        increment_bought({self.product_id: 1}, self.timestamp)
+        if self.product.alcohol_content_ml:
+            forget_bac(Member.objects.filter(pk=self.member_id))
 
     def delete(self, *args, **kwargs):
         if self.id:
+            decrement_bought(Sale.objects.filter(pk=self.pk))
             super(Sale, self).delete(*args, **kwargs)
+            forget_bac(Member.objects.filter(pk=self.member_id))
         else:
             raise RuntimeError("You can't delete a sale that hasn't happened")
 
+    @staticmethod
+    @transaction.atomic
+    def refund(sales, admin_user: User):
+        """
+        Refunds the given sales and logs it, with a constant number of
+        queries. Each member gets one balance update, no matter how many of
+        their sales are refunded, and sales_refunded is sent once for them all.
+        Returns the number of refunded sales.
+        """
+        # Lock only the sales here. Like Order.execute, lock the products
+        # before the members, so the two can't deadlock.
+        sales = list(sales.select_related(None).select_for_update())
+        if not sales:
+            return 0
+        refunded = Sale.objects.filter(pk__in=[sale.id for sale in sales])
+
+        totals = defaultdict(int)
+        for sale in sales:
+            totals[sale.member_id] += sale.price
+        decrement_bought(refunded)
+        Member.apply_payments(totals)
+        forget_bac(Member.objects.filter(pk__in=totals))
+        prefetch_related_objects(sales, 'member', 'product')
+        sales_refunded.send(sender=Sale, sales=sales)
+        with refunding_sales():
+            refunded.delete()
+
+        content_type_id = ContentType.objects.get_for_model(Sale).pk
+        LogEntry.objects.bulk_create(
+            LogEntry(
+                user_id=admin_user.pk,
+                content_type_id=content_type_id,
+                object_id=str(sale.id),
+                object_repr=str(sale)[:200],
+                action_flag=DELETION,
+                change_message="Refunded",
+            )
+            for sale in sales
+        )
+        invalidate_productlist()
+        return len(sales)
+
+
+def forget_bac(members):
+    """
+    Makes the given members recompute their BAC from their sales next time.
+    Used when sales are added or removed outside of Order.execute.
+    """
+    members.update(bac_timestamp=None)
+
+
+def increment_bought(counts, timestamp):
+    """
+    Adds sales made at timestamp to the bought counters.
+
+    counts maps product ids to the number of sales of that product. Unlimited
+    products, and products whose start_date is after the sale, are left alone.
+    """
+    sale_date = timezone.localdate(timestamp)
+    for product_id, count in counts.items():
+        Product.objects.filter(pk=product_id, start_date__lte=sale_date).update(bought_count=F('bought_count') + count)
+
+
+def reserve_bought(product_id, count, timestamp):
+    """
+    Counts count sales of a limited product made at timestamp towards bought,
+    if there is enough left of it. Otherwise raises NoMoreInventoryError.
+
+    The check and the increment is a single update, which locks the product
+    row until the transaction ends. Concurrent orders can't both get the last
+    of something.
+    """
+    sale_date = timezone.localdate(timestamp)
+    reserved = Product.objects.filter(
+        pk=product_id, start_date__lte=sale_date, bought_count__lte=F('quantity') - count
+    ).update(bought_count=F('bought_count') + count)
+    if reserved:
+        return
+    # Nothing was reserved, either because we are out of stock or because the
+    # product doesn't count this sale, as it is unlimited or hasn't started.
+    uncounted = Product.objects.filter(
+        Q(start_date__isnull=True) | Q(start_date__gt=sale_date, quantity__gte=F('bought_count') + count),
+        pk=product_id,
+    )
+    if not uncounted.exists():
+        raise NoMoreInventoryError()
+
+
+def decrement_bought(sales):
+    """
+    Removes the given sales from the bought counters. Must be called before
+    the sales are deleted.
+    """
+    counts = Counter()
+    limited_sales = sales.filter(product__start_date__isnull=False).values_list(
+        'product_id', 'product__start_date', 'timestamp'
+    )
+    for product_id, start_date, timestamp in limited_sales:
+        if timestamp > date_to_midnight(start_date):
+            counts[product_id] += 1
+    for product_id, count in counts.items():
+        Product.objects.filter(pk=product_id).update(bought_count=F('bought_count') - count)
+
 
 # XXX
 class News(models.Model):
@@ -628,3 +996,54 @@ class News(models.Model):
 
     def __str__(self):
         return self.title + " -- " + str(self.pub_date)
+
+
+class QueuedMail(models.Model):
+    """
+    An outgoing mail, waiting to be sent by the sendqueuedmail command.
+    Mails are deleted once they have been sent.
+    """
+
+    recipient = models.CharField(max_length=254)
+    message = models.TextField()
+    created = models.DateTimeField(auto_now_add=True)
+    attempts = models.IntegerField(default=0)
+    next_attempt = models.DateTimeField(default=timezone.now)
+    last_error = models.TextField(blank=True)
+
+    class Meta:
+        index_together = [
+            ["attempts", "next_attempt"],
+        ]
+
+    def __str__(self):
+        return f"{self.recipient} ({self.attempts} attempts)"
+
+
+class BalanceCheckpoint(models.Model):
+    """
+    The balance every member should have had, according to the payments and
+    sales up to and including last_payment_id and last_sale_id. Balances are
+    verified against the latest checkpoint, see stregsystem.balances.
+    """
+
+    created = models.DateTimeField(auto_now_add=True)
+    last_payment_id = models.IntegerField()
+    last_sale_id = models.IntegerField()
+
+    class Meta:
+        get_latest_by = 'id'
+
+    def __str__(self):
+        return f"{self.created} (payment {self.last_payment_id}, sale {self.last_sale_id})"
+
+
+class MemberBalance(models.Model):
+    checkpoint = models.ForeignKey(BalanceCheckpoint, on_delete=models.CASCADE)
+    member = models.ForeignKey(Member, on_delete=models.CASCADE)
+    balance = models.IntegerField()
+
+    class Meta:
+        unique_together = [
+            ["checkpoint", "member"],
+        ]
@@ -1,6 +1,9 @@
+import threading
+from contextlib import contextmanager
+
 from django.db.models.signals import post_save
 from django.db.models import F
-from django.dispatch import receiver
+from django.dispatch import Signal, receiver
 
 
 def after_member_save(sender, instance, created, **kwargs):
@@ -13,3 +16,59 @@ def after_member_save(sender, instance, created, **kwargs):
         return
 
     send_welcome_mail(instance)
+
+
+# Sent with sales which are about to be deleted, or have just been. Sale.refund
+# sends it once with all the refunded sales, and so does deleting a member,
+# product or room with all the sales the delete cascades to. Otherwise it is
+# sent for every deleted sale by after_sale_delete. Anything kept in step with
+# the sales should listen to this rather than post_delete.
+sales_refunded = Signal(providing_args=['sales'])
+
+# Set while Sale.refund deletes the sales it has already sent sales_refunded
+# for, and holds the members, products and rooms being deleted with their
+# sales. Thread local, as requests may be served by several threads.
+_refunding = threading.local()
+
+
+@contextmanager
+def refunding_sales():
+    _refunding.active = True
+    try:
+        yield
+    finally:
+        _refunding.active = False
+
+
+def _cascading():
+    if not hasattr(_refunding, 'cascading'):
+        _refunding.cascading = set()
+    return _refunding.cascading
+
+
+def before_sales_cascade(sender, instance, **kwargs):
+    """
+    Sends sales_refunded once for the sales of a member, product or room
+    which is about to be deleted, instead of once for every sale.
+    """
+    sales = list(instance.sale_set.all())
+    if sales:
+        sales_refunded.send(sender=instance.sale_set.model, sales=sales)
+    _cascading().add((sender._meta.model_name, instance.pk))
+
+
+def after_sales_cascade(sender, instance, **kwargs):
+    _cascading().discard((sender._meta.model_name, instance.pk))
+
+
+def after_sale_delete(sender, instance, **kwargs):
+    if getattr(_refunding, 'active', False):
+        return
+    cascading = _cascading()
+    if cascading and (
+        ('member', instance.member_id) in cascading
+        or ('product', instance.product_id) in cascading
+        or ('room', instance.room_id) in cascading
+    ):
+        return
+    sales_refunded.send(sender=sender, sales=[instance])
@@ -1,17 +1,35 @@
 # -*- coding: utf-8 -*-
 import datetime
+import http.server
+import json
+import logging
+import os
+import random
+import smtplib
+import socketserver
+import tempfile
+import threading
+import time
+import urllib.parse
 from collections import Counter
 from copy import deepcopy
+from io import StringIO
 from unittest.mock import patch
 
 import pytz
 from django.utils.dateparse import parse_datetime
 import stregsystem.parser as parser
 from django.contrib.auth.models import User
+from django.contrib.admin.models import ADDITION, DELETION, LogEntry
 from django.contrib.admin.sites import AdminSite
 from django.contrib.messages import get_messages
+from django.core.cache import cache
+from django.core.management import call_command
+from django.db import OperationalError, connection
+from django.db.models import F
 from django.forms import model_to_dict
-from django.test import TestCase
+from django.test import RequestFactory, TestCase, TransactionTestCase
+from django.test.utils import CaptureQueriesContext
 from django.urls import reverse
 from django.utils import timezone
 from freezegun import freeze_time
@@ -19,8 +37,13 @@ from stregreport import views
 from stregsystem import admin
 from stregsystem import views as stregsystem_views
 from stregsystem.admin import CategoryAdmin, ProductAdmin, MemberForm, MemberAdmin
+from stregsystem.management.commands import importmobilepaypayments
 from stregsystem.booze import ballmer_peak
+from stregsystem.balances import make_balance_checkpoint, verify_balances
+from stregsystem.caches import PRODUCTLIST_CACHE_TIMEOUT, _productlist_timeout, get_active_productlist
+from stregsystem.mail import MAIL_RETRY_DELAY, send_email, send_queued_mail
 from stregsystem.models import (
+    BalanceCheckpoint,
     Category,
     GetTransaction,
     Member,
@@ -36,8 +59,23 @@ from stregsystem.models import (
     active_str,
     price_display,
     MobilePayment,
+    OldPrice,
+    QueuedMail,
 )
-from stregsystem.utils import mobile_payment_exact_match_member, strip_emoji, MobilePaytoolException
+from stregsystem.utils import (
+    mobile_payment_exact_match_member,
+    mobile_payment_exact_match_members,
+    strip_emoji,
+    MobilePaytoolException,
+)
+
+logger = logging.getLogger(__name__)
+
+
+def admin_refund(sales):
+    request = RequestFactory().post(reverse('admin:stregsystem_sale_changelist'))
+    request.user, _ = User.objects.get_or_create(username="refunder", defaults={'is_staff': True})
+    admin.SaleAdmin(Sale, AdminSite()).refund(request, sales)
 
 
 def assertCountEqual(case, *args, **kwargs):
@@ -314,6 +352,47 @@ class SaleViewTests(TestCase):
         self.assertTrue(give_multibuy_hint)
         self.assertEqual(sale_hints, "{} {}:{}".format("<span class=\"username\">jokke</span>", coke.id, 2))
 
+    def test_multibuy_hint_single_query(self):
+        member = Member.objects.get(username="jokke")
+        coke = Product.objects.create(name="coke", price=100, active=True)
+        beer = Product.objects.create(name="beer", price=100, active=True)
+        with freeze_time(timezone.datetime(2018, 1, 1)) as frozen_time:
+            for product in [coke, beer, coke, coke, beer, coke]:
+                Sale.objects.create(
+                    member=member,
+                    product=product,
+                    price=100,
+                )
+                frozen_time.tick()
+            Sale.objects.create(member=member, product=Product.objects.get(id=1), price=900)
+
+        with self.assertNumQueries(1):
+            give_multibuy_hint, sale_hints = stregsystem_views._multibuy_hint(
+                timezone.datetime(2018, 1, 1, tzinfo=pytz.UTC), member
+            )
+        self.assertTrue(give_multibuy_hint)
+        self.assertEqual(
+            sale_hints,
+            "{} {}:{} {}:{} {}".format("<span class=\"username\">jokke</span>", coke.id, 4, beer.id, 2, 1),
+        )
+
+    def test_resolve_products_single_query(self):
+        room = Room.objects.get(id=1)
+        with self.assertNumQueries(1):
+            products = stregsystem_views._resolve_products([1] * 10 + [2], room, timezone.now())
+        self.assertEqual(set(products.keys()), {1, 2})
+
+    def test_resolve_products_skips_unavailable(self):
+        room = Room.objects.get(id=1)
+        products = stregsystem_views._resolve_products([1, 4, 99], room, timezone.now())
+        self.assertEqual(set(products.keys()), {1})
+
+    def test_quicksale_reports_first_missing_product(self):
+        response = self.client.post(reverse('quickbuy', args=(1,)), {"quickbuy": "jokke 1 98 99"})
+
+        self.assertTemplateUsed(response, "stregsystem/error_productdoesntexist.html")
+        self.assertEqual(response.context["failedProduct"], 98)
+
 
 class UserInfoViewTests(TestCase):
     def setUp(self):
@@ -447,11 +526,40 @@ class OrderTest(TestCase):
 
         fulfill.assert_called_once_with(PayTransaction(20))
 
+    def test_order_execute_creates_sale_per_item(self):
+        order = Order(self.member, self.room)
+
+        item = OrderItem(self.product, order, 3)
+        order.items.add(item)
+
+        order.execute()
+
+        sales = Sale.objects.filter(member=self.member)
+        self.assertEqual(sales.count(), 3)
+        for sale in sales:
+            self.assertEqual(sale.product, self.product)
+            self.assertEqual(sale.room, self.room)
+            self.assertEqual(sale.price, 10)
+
+    def test_order_execute_query_count_constant(self):
+        self.member.balance = 100000
+        self.member.save()
+
+        def execute_queries(count):
+            order = Order(self.member, self.room)
+            order.items.add(OrderItem(self.product, order, count))
+            with CaptureQueriesContext(connection) as context:
+                order.execute()
+            return len(context.captured_queries)
+
+        self.assertEqual(execute_queries(1), execute_queries(20))
+
     @patch('stregsystem.models.Member.fulfill')
     def test_order_execute_single_no_remaining(self, fulfill):
-        self.product.sale_set.create(price=100, member=self.member)
         self.product.start_date = datetime.date(year=2017, month=1, day=1)
         self.product.quantity = 1
+        self.product.save()
+        self.product.sale_set.create(price=100, member=self.member)
         order = Order(self.member, self.room)
 
         item = OrderItem(self.product, order, 1)
@@ -464,9 +572,10 @@ class OrderTest(TestCase):
 
     @patch('stregsystem.models.Member.fulfill')
     def test_order_execute_multi_some_remaining(self, fulfill):
-        self.product.sale_set.create(price=100, member=self.member)
         self.product.start_date = datetime.date(year=2017, month=1, day=1)
         self.product.quantity = 2
+        self.product.save()
+        self.product.sale_set.create(price=100, member=self.member)
         order = Order(self.member, self.room)
 
         item = OrderItem(self.product, order, 2)
@@ -493,6 +602,64 @@ class OrderTest(TestCase):
         self.assertEqual(balance_before, balance_after)
 
 
+class InventoryConcurrencyTests(TransactionTestCase):
+    """
+    Hammers a limited product from many threads at once. Every thread has its
+    own database connection, so this exercises the locking of the database and
+    not just our own code.
+    """
+
+    workers = 8
+    orders_per_worker = 10
+    quantity = 25
+
+    def setUp(self):
+        self.room = Room.objects.create(name="room")
+        self.product = Product.objects.create(
+            name="billet", price=100, active=True, start_date=datetime.date(2017, 1, 1), quantity=self.quantity
+        )
+        self.members = [Member.objects.create(username=f"worker{i}", balance=100000) for i in range(self.workers)]
+
+    def buy_tickets(self, member, results):
+        try:
+            for _ in range(self.orders_per_worker):
+                while True:
+                    try:
+                        Order.from_products(member, self.room, [self.product]).execute()
+                        results.append(True)
+                    except NoMoreInventoryError:
+                        results.append(False)
+                    except OperationalError:
+                        # SQLite gives up right away if the database is
+                        # locked by another connection, so try again
+                        continue
+                    break
+        finally:
+            connection.close()
+
+    def test_no_oversell(self):
+        results = []
+        threads = [threading.Thread(target=self.buy_tickets, args=(member, results)) for member in self.members]
+        start = time.perf_counter()
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        elapsed = time.perf_counter() - start
+
+        self.assertEqual(len(results), self.workers * self.orders_per_worker)
+        self.assertEqual(results.count(True), self.quantity)
+        self.assertEqual(Sale.objects.filter(product=self.product).count(), self.quantity)
+        self.assertEqual(self.product.bought, self.quantity)
+        members = Member.objects.filter(pk__in=[member.pk for member in self.members])
+        self.assertEqual(sum(100000 - member.balance for member in members), self.quantity * 100)
+
+        logger.info(
+            f"{len(results)} orders from {self.workers} workers in {elapsed:.2f}s "
+            f"({len(results) / elapsed:.0f} orders/s)"
+        )
+
+
 class PaymentTests(TestCase):
     def setUp(self):
         self.member = Member.objects.create(username="jon", balance=100)
@@ -532,6 +699,268 @@ class PaymentTests(TestCase):
         with self.assertRaises(AssertionError):
             payment.delete()
 
+    def test_payments_through_stale_members_add_up(self):
+        Payment(member=Member.objects.get(pk=self.member.pk), amount=100).save()
+        Payment(member=Member.objects.get(pk=self.member.pk), amount=50).save()
+        payment = Payment.objects.filter(amount=100).get()
+        payment.delete()
+
+        self.member.refresh_from_db()
+        self.assertEqual(self.member.balance, 150)
+
+    def test_payment_save_doesnt_select_member(self):
+        payment = Payment(member=self.member, amount=100)
+
+        with self.assertNumQueries(4):  # savepoint, insert, update, release
+            payment.save()
+
+
+class BalanceVerificationTests(TestCase):
+    def setUp(self):
+        self.room = Room.objects.create(name="room")
+        self.product = Product.objects.create(name="øl", price=600, active=True)
+        self.jon = Member.objects.create(username="jon")
+        self.ida = Member.objects.create(username="ida")
+        with freeze_time(timezone.now() - datetime.timedelta(hours=1)):
+            Payment(member=self.jon, amount=5000).save()
+            Payment(member=self.ida, amount=2000).save()
+            self.buy(self.jon, 3)
+            self.buy(self.ida, 1)
+
+    def buy(self, member, count):
+        order = Order(member, self.room)
+        order.items.add(OrderItem(self.product, order, count))
+        order.execute()
+
+    def test_balances_match(self):
+        self.assertEqual([], verify_balances())
+        make_balance_checkpoint()
+        self.buy(self.jon, 2)
+        Payment(member=self.ida, amount=100).save()
+
+        self.assertEqual([], verify_balances())
+
+    def test_deleted_mobilepayment_is_not_drift(self):
+        admin = User.objects.create_superuser("admin", "admin@example.com", "hunter2")
+        with freeze_time(timezone.now() - datetime.timedelta(hours=1)):
+            mobile_payment = MobilePayment.objects.create(
+                member=self.jon,
+                amount=3000,
+                comment="jon",
+                timestamp=timezone.now(),
+                transaction_id="1",
+                status=MobilePayment.APPROVED,
+            )
+            MobilePayment.submit_processed_mobile_payments(admin)
+        make_balance_checkpoint()
+
+        MobilePayment.objects.get(pk=mobile_payment.pk).delete()
+
+        self.assertEqual(5000 - 3 * 600, Member.objects.get(pk=self.jon.pk).balance)
+        self.assertFalse(Payment.objects.filter(member=self.jon, amount=3000).exists())
+        self.assertEqual([], verify_balances())
+
+    def test_drift_is_reported(self):
+        make_balance_checkpoint()
+        Member.objects.filter(pk=self.ida.pk).update(balance=F('balance') + 7)
+
+        drifts = verify_balances()
+
+        self.assertEqual([(self.ida, 1400)], [(drift.member, drift.expected) for drift in drifts])
+        self.assertEqual(7, drifts[0].drift)
+
+    def test_checkpoint_leaves_out_recent_history(self):
+        self.buy(self.jon, 1)
+        checkpoint = make_balance_checkpoint()
+
+        self.assertEqual(Sale.objects.order_by('id')[3].id, checkpoint.last_sale_id)
+        self.assertEqual(5000 - 3 * 600, checkpoint.memberbalance_set.get(member=self.jon).balance)
+        self.assertEqual([], verify_balances())
+
+    def test_checkpoint_follows_refunds_and_deleted_payments(self):
+        make_balance_checkpoint()
+        admin_refund(Sale.objects.filter(pk=Sale.objects.filter(member=self.jon).first().pk))
+        Payment.objects.get(member=self.ida).delete()
+        make_balance_checkpoint()
+
+        self.assertEqual([], verify_balances())
+
+    def test_verify_queries_dont_depend_on_history(self):
+        make_balance_checkpoint()
+        self.buy(self.jon, 1)
+
+        with self.assertNumQueries(5):
+            verify_balances()
+        with freeze_time(timezone.now() - datetime.timedelta(minutes=30)):
+            Payment(member=self.jon, amount=10000).save()
+            for _ in range(10):
+                self.buy(self.jon, 1)
+        Member.objects.filter(pk=self.ida.pk).update(balance=F('balance') + 7)
+        with self.assertNumQueries(6):
+            verify_balances()
+
+    def test_old_checkpoints_are_deleted(self):
+        for _ in range(32):
+            make_balance_checkpoint()
+
+        self.assertEqual(30, BalanceCheckpoint.objects.count())
+
+    def test_command(self):
+        Member.objects.filter(pk=self.jon.pk).update(balance=F('balance') - 100)
+        out = StringIO()
+
+        call_command('verifybalances', '--checkpoint', stdout=out)
+
+        self.assertIn("jon", out.getvalue())
+        self.assertIn("1 balances have drifted", out.getvalue())
+        self.assertEqual(1, BalanceCheckpoint.objects.count())
+
+
+class SaleRefundTests(TestCase):
+    def setUp(self):
+        self.admin_user = User.objects.create_superuser("admin", "admin@example.com", "hunter2")
+        self.room = Room.objects.create(name="room")
+        self.ticket = Product.objects.create(
+            name="billet", price=5000, active=True, quantity=100, start_date=datetime.date(2017, 1, 1)
+        )
+        self.jon = Member.objects.create(username="jon", balance=1000000)
+        self.ida = Member.objects.create(username="ida", balance=1000000)
+
+    def buy(self, member, count):
+        order = Order(member, self.room)
+        order.items.add(OrderItem(self.ticket, order, count))
+        order.execute()
+
+    def refund_queries(self, count):
+        self.buy(self.jon, count)
+        self.buy(self.ida, count)
+        with CaptureQueriesContext(connection) as context:
+            refunded = Sale.refund(Sale.objects.filter(product=self.ticket), self.admin_user)
+        self.assertEqual(2 * count, refunded)
+        return len(context.captured_queries)
+
+    def test_refund(self):
+        self.buy(self.jon, 3)
+        self.buy(self.ida, 1)
+
+        Sale.refund(Sale.objects.filter(product=self.ticket), self.admin_user)
+
+        self.assertEqual([1000000, 1000000], [Member.objects.get(pk=m.pk).balance for m in [self.jon, self.ida]])
+        self.assertFalse(Sale.objects.exists())
+        self.assertEqual(0, Product.objects.get(pk=self.ticket.pk).bought_count)
+        self.assertEqual(4, LogEntry.objects.filter(action_flag=DELETION, change_message="Refunded").count())
+
+    def test_refund_queries_constant(self):
+        self.assertEqual(self.refund_queries(2), self.refund_queries(25))
+
+    def test_refund_locks_products_before_members(self):
+        # the same order as Order.execute, so the two can't deadlock
+        self.buy(self.jon, 2)
+        with CaptureQueriesContext(connection) as context:
+            Sale.refund(Sale.objects.filter(product=self.ticket), self.admin_user)
+
+        updates = [query["sql"] for query in context.captured_queries if query["sql"].startswith("UPDATE")]
+        self.assertIn('"stregsystem_product"', updates[0])
+        self.assertIn('"stregsystem_member"', updates[1])
+
+    def test_refund_nothing(self):
+        self.assertEqual(0, Sale.refund(Sale.objects.none(), self.admin_user))
+        self.assertFalse(LogEntry.objects.exists())
+
+
+class AdminChangelistQueryTests(TestCase):
+    def setUp(self):
+        User.objects.create_superuser("superuser", "superuser@example.com", "hunter2")
+        self.client.login(username="superuser", password="hunter2")
+        self.room = Room.objects.create(name="room")
+        self.product = Product.objects.create(name="øl", price=600, active=True)
+        self.members = 0
+
+    def add_rows(self, count):
+        for _ in range(count):
+            self.members += 1
+            member = Member.objects.create(username=f"member{self.members}", balance=10000)
+            Sale.objects.create(member=member, product=self.product, room=self.room, price=600)
+            payment = Payment.objects.create(member=member, amount=100)
+            MobilePayment.objects.create(
+                member=member,
+                payment=payment,
+                amount=100,
+                timestamp=timezone.now(),
+                transaction_id=f"trans{self.members}",
+                status=MobilePayment.APPROVED,
+            )
+            Payment.objects.create(member=member, amount=200)
+
+    def changelist_queries(self, url, count):
+        self.add_rows(count)
+        with CaptureQueriesContext(connection) as context:
+            response = self.client.get(url)
+        self.assertEqual(200, response.status_code)
+        return len(context.captured_queries)
+
+    def test_sale_changelist(self):
+        url = reverse('admin:stregsystem_sale_changelist')
+        self.assertEqual(self.changelist_queries(url, 2), self.changelist_queries(url, 20))
+
+    def test_payment_changelist(self):
+        url = reverse('admin:stregsystem_payment_changelist')
+        self.assertEqual(self.changelist_queries(url, 2), self.changelist_queries(url, 20))
+
+    def test_mobilepayment_changelist(self):
+        url = reverse('admin:stregsystem_mobilepayment_changelist')
+        self.assertEqual(self.changelist_queries(url, 2), self.changelist_queries(url, 20))
+
+    def test_payment_changelist_sorted_by_mobilepayment(self):
+        self.add_rows(3)
+
+        response = self.client.get(reverse('admin:stregsystem_payment_changelist') + "?o=-4")
+
+        self.assertEqual(
+            [True] * 3 + [False] * 3, [payment.from_mobilepayment for payment in response.context['cl'].result_list]
+        )
+
+
+class MemberLedgerTests(TestCase):
+    def setUp(self):
+        self.member = Member.objects.create(username="jon", balance=100)
+
+    def test_apply_transaction(self):
+        self.member.apply_transaction(PayTransaction(60))
+
+        self.assertEqual(self.member.balance, 40)
+        self.member.refresh_from_db()
+        self.assertEqual(self.member.balance, 40)
+
+    def test_apply_transaction_checks_database_balance(self):
+        stale = Member.objects.get(pk=self.member.pk)
+        self.member.apply_transaction(PayTransaction(60))
+
+        with self.assertRaises(StregForbudError):
+            stale.apply_transaction(PayTransaction(60))
+
+        self.member.refresh_from_db()
+        self.assertEqual(self.member.balance, 40)
+
+    def test_revert_transaction(self):
+        stale = Member.objects.get(pk=self.member.pk)
+        self.member.apply_transaction(PayTransaction(60))
+        stale.revert_transaction(PayTransaction(10))
+
+        self.member.refresh_from_db()
+        self.assertEqual(self.member.balance, 50)
+
+    def test_admin_sale_without_money(self):
+        product = Product.objects.create(name="øl", price=1000, active=True)
+        sale = Sale(member=self.member, product=product, price=product.price)
+
+        with self.assertRaises(StregForbudError):
+            admin.SaleAdmin(Sale, AdminSite()).save_model(None, sale, None, False)
+
+        self.member.refresh_from_db()
+        self.assertEqual(self.member.balance, 100)
+        self.assertFalse(Sale.objects.exists())
+
 
 class ProductTests(TestCase):
     def setUp(self):
@@ -608,6 +1037,91 @@ class ProductTests(TestCase):
 
         self.assertFalse(product.is_active())
 
+    def test_bought_single_query(self):
+        product = Product.objects.create(
+            active=True, price=100, quantity=10, start_date=datetime.date(year=2017, month=1, day=1)
+        )
+        product.sale_set.create(price=100, member=self.jeff)
+
+        with self.assertNumQueries(1):
+            self.assertEqual(product.bought, 1)
+
+    def test_bought_counts_order(self):
+        room = Room.objects.create(name="room")
+        self.jeff.balance = 1000
+        self.jeff.save()
+        product = Product.objects.create(
+            active=True, price=100, quantity=10, start_date=datetime.date(year=2017, month=1, day=1)
+        )
+
+        Order.from_products(self.jeff, room, [product, product, product]).execute()
+
+        self.assertEqual(product.bought, 3)
+
+    def test_bought_unlimited_not_counted(self):
+        product = Product.objects.create(active=True, price=100)
+        product.sale_set.create(price=100, member=self.jeff)
+
+        self.assertEqual(Product.objects.get(pk=product.pk).bought_count, 0)
+
+    def test_bought_refund(self):
+        product = Product.objects.create(
+            active=True, price=100, quantity=10, start_date=datetime.date(year=2017, month=1, day=1)
+        )
+        product.sale_set.create(price=100, member=self.jeff)
+        product.sale_set.create(price=100, member=self.jeff)
+        product.sale_set.create(price=100, member=self.jeff)
+
+        refunded = list(Sale.objects.filter(product=product).values_list('pk', flat=True))[:2]
+        admin_refund(Sale.objects.filter(pk__in=refunded))
+
+        self.assertEqual(product.bought, 1)
+
+    def test_bought_delete_sale(self):
+        product = Product.objects.create(
+            active=True, price=100, quantity=10, start_date=datetime.date(year=2017, month=1, day=1)
+        )
+        sale = product.sale_set.create(price=100, member=self.jeff)
+
+        sale.delete()
+
+        self.assertEqual(product.bought, 0)
+
+    def test_bought_recounted_on_start_date_change(self):
+        product = Product.objects.create(active=True, price=100, quantity=10)
+        with freeze_time(timezone.datetime(2017, 1, 1, 12, tzinfo=pytz.UTC)):
+            product.sale_set.create(price=100, member=self.jeff)
+        with freeze_time(timezone.datetime(2017, 2, 1, 12, tzinfo=pytz.UTC)):
+            product.sale_set.create(price=100, member=self.jeff)
+
+        product.start_date = datetime.date(year=2017, month=1, day=15)
+        product.save()
+
+        self.assertEqual(product.bought, 1)
+
+    def test_save_does_not_overwrite_bought(self):
+        product = Product.objects.create(
+            active=True, price=100, quantity=10, start_date=datetime.date(year=2017, month=1, day=1)
+        )
+        stale = Product.objects.get(pk=product.pk)
+        product.sale_set.create(price=100, member=self.jeff)
+
+        stale.name = "billet"
+        stale.save()
+
+        self.assertEqual(product.bought, 1)
+
+    def test_recountbought_command(self):
+        product = Product.objects.create(
+            active=True, price=100, quantity=10, start_date=datetime.date(year=2017, month=1, day=1)
+        )
+        product.sale_set.create(price=100, member=self.jeff)
+        Product.objects.filter(pk=product.pk).update(bought_count=42)
+
+        call_command('recountbought', stdout=StringIO())
+
+        self.assertEqual(product.bought, 1)
+
 
 class SaleTests(TestCase):
     def setUp(self):
@@ -761,6 +1275,61 @@ class MemberTests(TestCase):
         with freeze_time(timezone.datetime(year=2000, month=1, day=1, hour=0, minute=50)) as ft:
             self.assertAlmostEqual(1.15, user.calculate_alcohol_promille(), places=2)
 
+    def test_promille_incremental_orders_male(self):
+        user = Member.objects.create(username="test", gender='M', balance=10000)
+        room = Room.objects.create(name="room")
+
+        # (330 ml * 4.6%) = 15.18
+        alcoholic_drink = Product.objects.create(name="øl", price=2.0, alcohol_content_ml=15.18, active=True)
+
+        with freeze_time(timezone.datetime(year=2000, month=1, day=1, hour=0, minute=0)) as ft:
+            for i in range(5):
+                ft.tick(delta=datetime.timedelta(minutes=10))
+                Order.from_products(user, room, [alcoholic_drink]).execute()
+
+        user.refresh_from_db()
+        self.assertIsNotNone(user.bac_timestamp)
+
+        with freeze_time(timezone.datetime(year=2000, month=1, day=1, hour=0, minute=50)) as ft:
+            self.assertAlmostEqual(0.97, user.calculate_alcohol_promille(), places=2)
+
+        with freeze_time(timezone.datetime(year=2000, month=1, day=1, hour=2, minute=0)) as ft:
+            self.assertAlmostEqual(
+                user._calculate_bac_from_sales(timezone.now()), user.calculate_alcohol_promille(), places=6
+            )
+
+    def test_promille_multiple_in_one_order(self):
+        user = Member.objects.create(username="test", gender='F', balance=10000)
+        room = Room.objects.create(name="room")
+        alcoholic_drink = Product.objects.create(name="øl", price=2.0, alcohol_content_ml=15.18, active=True)
+        Order.from_products(user, room, [alcoholic_drink]).execute()
+
+        Order.from_products(user, room, [alcoholic_drink, alcoholic_drink]).execute()
+
+        self.assertAlmostEqual(
+            user._calculate_bac_from_sales(timezone.now()), user.calculate_alcohol_promille(), places=4
+        )
+
+    def test_promille_known_state_single_query(self):
+        user = Member.objects.create(username="test", gender='M', balance=10000)
+        room = Room.objects.create(name="room")
+        alcoholic_drink = Product.objects.create(name="øl", price=2.0, alcohol_content_ml=15.18, active=True)
+        for i in range(5):
+            Order.from_products(user, room, [alcoholic_drink]).execute()
+
+        with self.assertNumQueries(1):
+            user.calculate_alcohol_promille()
+
+    def test_promille_refund_recomputes(self):
+        user = Member.objects.create(username="test", gender='M', balance=10000)
+        room = Room.objects.create(name="room")
+        alcoholic_drink = Product.objects.create(name="øl", price=2.0, alcohol_content_ml=15.18, active=True)
+        Order.from_products(user, room, [alcoholic_drink]).execute()
+
+        admin_refund(Sale.objects.filter(member=user))
+
+        self.assertEqual(0.0, user.calculate_alcohol_promille())
+
 
 class BallmerPeakTests(TestCase):
     def test_close_to_maximum(self):
@@ -798,6 +1367,57 @@ class BallmerPeakTests(TestCase):
         self.assertFalse(is_balmer_peaking)
 
 
+class MemberUsernameLookupTests(TestCase):
+    def setUp(self):
+        self.jeff = Member.objects.create(username="Jeff", firstname="jeff", lastname="jefferson", gender="M")
+        self.marx = Member.objects.create(username="marx", firstname="Karl", lastname="Marx", gender="M")
+
+    def test_with_username_ignores_case(self):
+        self.assertEqual([self.jeff], list(Member.with_username("jEFF")))
+        self.assertEqual([], list(Member.with_username("jef")))
+
+    def test_with_username_exact(self):
+        self.assertEqual([self.jeff], list(Member.with_username("Jeff", exact=True)))
+        self.assertEqual([], list(Member.with_username("jeff", exact=True)))
+
+    def test_with_usernames(self):
+        self.assertEqual({self.jeff, self.marx}, set(Member.with_usernames(["JEFF", "Marx", "nobody"])))
+
+    def test_with_usernames_non_ascii(self):
+        # lowered by the database on both sides, even where it only folds ASCII
+        aero = Member.objects.create(username="Ærø", firstname="Ærø", lastname="Ærø", gender="M")
+        self.assertEqual([aero], list(Member.with_usernames(["ÆRø"])))
+        self.assertEqual([aero], list(Member.with_username("ÆRø")))
+
+    def test_with_username_uses_index(self):
+        query, params = Member.with_username("jeff").query.sql_with_params()
+        with connection.cursor() as cursor:
+            cursor.execute("EXPLAIN QUERY PLAN " + query, params)
+            plan = " ".join(str(row) for row in cursor.fetchall())
+        self.assertIn("stregsystem_member_username_lower", plan)
+
+    def test_with_username_benchmark(self):
+        Member.objects.bulk_create(
+            Member(username=f"User{i}", firstname="Bench", lastname="Mark", gender="U") for i in range(50000)
+        )
+        usernames = [f"user{i}" for i in random.Random(1337).sample(range(50000), 200)]
+
+        start = time.perf_counter()
+        expected = [Member.objects.get(username__iexact=username) for username in usernames]
+        iexact_seconds = time.perf_counter() - start
+
+        start = time.perf_counter()
+        members = [Member.with_username(username).get() for username in usernames]
+        index_seconds = time.perf_counter() - start
+
+        logger.info(
+            "200 lookups among 50000 members: username__iexact %.3fs, with_username %.3fs",
+            iexact_seconds,
+            index_seconds,
+        )
+        self.assertEqual(expected, members)
+
+
 class MemberModelFormTests(TestCase):
     def setUp(self):
         jeff = Member.objects.create(username="jeff", firstname="jeff", lastname="jefferson", gender="M")
@@ -850,6 +1470,176 @@ class MemberAdminTests(TestCase):
         self.assertEqual("mr_jefferson", Member.objects.filter(pk=2).get().username)
 
 
+class ProductAdminActivatedTests(TestCase):
+    def setUp(self):
+        User.objects.create_superuser("superuser", "superuser@example.com", "hunter2")
+        self.client.login(username="superuser", password="hunter2")
+        self.jeff = Member.objects.create(username="jeff")
+        self.products = 0
+
+    def add_products(self, count):
+        for _ in range(count):
+            self.products += 1
+            product = Product.objects.create(
+                name=f"limited{self.products}",
+                price=100,
+                active=True,
+                start_date=datetime.date(2017, 1, 1),
+                quantity=self.products % 2,
+            )
+            product.sale_set.create(price=100, member=self.jeff)
+            Product.objects.create(
+                name=f"expired{self.products}",
+                price=100,
+                active=True,
+                deactivate_date=timezone.now() - datetime.timedelta(hours=1),
+            )
+            Product.objects.create(name=f"plain{self.products}", price=100, active=self.products % 2 == 0)
+
+    def changelist(self, query=""):
+        response = self.client.get(reverse('admin:stregsystem_product_changelist') + query)
+        self.assertEqual(200, response.status_code)
+        return response.context['cl'].result_list
+
+    def changelist_queries(self, count):
+        self.add_products(count)
+        with CaptureQueriesContext(connection) as context:
+            self.changelist()
+        return len(context.captured_queries)
+
+    def test_activated_matches_is_active(self):
+        self.add_products(4)
+
+        products = self.changelist()
+
+        self.assertEqual([product.is_active() for product in products], [product.activated for product in products])
+        self.assertIn(True, [product.activated for product in products])
+
+    def test_changelist_queries_constant(self):
+        self.assertEqual(self.changelist_queries(2), self.changelist_queries(20))
+
+    def test_sort_by_activated(self):
+        self.add_products(4)
+
+        products = self.changelist("?o=-1")
+
+        activated = [product.activated for product in products]
+        self.assertEqual(sorted(activated, reverse=True), activated)
+
+
+class PriceHistoryTests(TestCase):
+    def setUp(self):
+        self.product = Product.objects.create(name="øl", price=600, active=True)
+
+    def prices(self):
+        return list(self.product.old_prices.order_by('changed_on', 'id').values_list('price', flat=True))
+
+    def test_new_product_has_price(self):
+        self.assertEqual([600], self.prices())
+
+    def test_unchanged_price_is_not_recorded(self):
+        product = Product.objects.get(pk=self.product.pk)
+        product.name = "pilsner"
+
+        with self.assertNumQueries(1):
+            product.save()
+
+        self.assertEqual([600], self.prices())
+
+    def test_changed_price_is_recorded(self):
+        product = Product.objects.get(pk=self.product.pk)
+        product.price = 700
+        product.save()
+        product.save()
+        product.price = 600
+        product.save()
+
+        self.assertEqual([600, 700, 600], self.prices())
+
+    def test_price_at(self):
+        start = timezone.now()
+        with freeze_time(start + datetime.timedelta(days=1)):
+            self.product.price = 700
+            self.product.save()
+        with freeze_time(start + datetime.timedelta(days=2)):
+            self.product.price = 800
+            self.product.save()
+
+        times = [start - datetime.timedelta(days=1)] + [start + datetime.timedelta(days=n, hours=1) for n in range(3)]
+        self.assertEqual([None, 600, 700, 800], [self.product.price_at(timestamp) for timestamp in times])
+        with self.assertNumQueries(1):
+            prices = Product.prices_at((self.product.id, timestamp) for timestamp in times)
+        self.assertEqual([None, 600, 700, 800], prices)
+
+    def test_prices_at_benchmark(self):
+        start = datetime.datetime(2020, 1, 1, tzinfo=pytz.UTC)
+        products = Product.objects.bulk_create(Product(name=f"product{i}", price=100, active=True) for i in range(1000))
+        if products[0].id is None:
+            products = list(Product.objects.filter(name__startswith="product"))
+        rng = random.Random(1337)
+        with freeze_time(start, auto_tick_seconds=60):
+            OldPrice.objects.bulk_create(
+                OldPrice(product=product, price=rng.randrange(100, 1000)) for _ in range(20) for product in products
+            )
+        end = start + datetime.timedelta(minutes=20 * len(products))
+        lookups = [
+            (rng.choice(products).id, start + (end - start) * rng.random() - datetime.timedelta(days=1))
+            for _ in range(1000000)
+        ]
+
+        started = time.perf_counter()
+        prices = Product.prices_at(lookups)
+        batch_seconds = time.perf_counter() - started
+
+        started = time.perf_counter()
+        expected = [Product(id=product_id).price_at(timestamp) for product_id, timestamp in lookups[:1000]]
+        single_seconds = time.perf_counter() - started
+
+        logger.info(
+            "1000000 price lookups over 20000 price changes: prices_at %.3fs, price_at %.3fs for the first 1000",
+            batch_seconds,
+            single_seconds,
+        )
+        self.assertEqual(expected, prices[:1000])
+
+    def test_compact_old_prices(self):
+        for price in [600, 600, 700, 700, 600]:
+            OldPrice.objects.create(product=self.product, price=price)
+        other = Product.objects.create(name="sodavand", price=600, active=True)
+        OldPrice.objects.create(product=other, price=600)
+
+        call_command('compactoldprices', stdout=StringIO())
+
+        self.assertEqual([600, 700, 600], self.prices())
+        self.assertEqual(1, other.old_prices.count())
+
+
+class ToggleActiveProductsTests(TestCase):
+    def setUp(self):
+        self.room = Room.objects.create(name="room")
+        self.on = Product.objects.create(
+            name="on", price=100, active=True, deactivate_date=timezone.now() + datetime.timedelta(days=1)
+        )
+        self.off = Product.objects.create(name="off", price=200, active=False)
+
+    def test_toggle(self):
+        with self.assertNumQueries(1):
+            admin.toggle_active_selected_products(None, None, Product.objects.all())
+
+        self.assertEqual(
+            [("on", False, None), ("off", True, None)],
+            list(Product.objects.order_by('id').values_list('name', 'active', 'deactivate_date')),
+        )
+        self.assertEqual(2, OldPrice.objects.count())
+
+    def test_toggle_invalidates_productlist(self):
+        self.assertEqual([self.on], get_active_productlist(self.room.id))
+
+        admin.toggle_active_selected_products(None, None, Product.objects.all())
+
+        self.assertEqual([self.off], get_active_productlist(self.room.id))
+
+
 class ProductActivatedListFilterTests(TestCase):
     def setUp(self):
         jeff = Member.objects.create(username="jeff")
@@ -992,6 +1782,61 @@ class ProductRoomFilterTests(TestCase):
         self.assertEqual(len(products), len(Product.objects.all()))
 
 
+class ProductListCacheTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.room = Room.objects.create(name="room")
+        self.member = Member.objects.create(username="jokke", balance=10000)
+        self.product = Product.objects.create(name="øl", price=100, active=True)
+
+    def test_cached_list_does_not_query(self):
+        get_active_productlist(self.room.id)
+        with self.assertNumQueries(0):
+            product_list = get_active_productlist(self.room.id)
+        self.assertEqual(product_list, [self.product])
+
+    def test_invalidated_on_product_save(self):
+        get_active_productlist(self.room.id)
+        self.product.active = False
+        self.product.save()
+
+        self.assertEqual(get_active_productlist(self.room.id), [])
+
+    def test_invalidated_on_room_change(self):
+        other_room = Room.objects.create(name="other room")
+        get_active_productlist(self.room.id)
+        self.product.rooms.add(other_room)
+
+        self.assertEqual(get_active_productlist(self.room.id), [])
+        self.assertEqual(get_active_productlist(other_room.id), [self.product])
+
+    def test_invalidated_when_sold_out(self):
+        ticket = Product.objects.create(
+            name="billet", price=100, active=True, start_date=datetime.date(2017, 1, 1), quantity=1
+        )
+        self.assertIn(ticket, get_active_productlist(self.room.id))
+
+        Order.from_products(self.member, self.room, [ticket]).execute()
+
+        self.assertNotIn(ticket, get_active_productlist(self.room.id))
+
+    def test_expires_at_deactivate_date(self):
+        with freeze_time(timezone.datetime(2018, 1, 1, tzinfo=pytz.UTC)):
+            Product.objects.create(
+                name="julebryg",
+                price=100,
+                active=True,
+                deactivate_date=timezone.datetime(2018, 1, 1, 0, 0, 3, tzinfo=pytz.UTC),
+            )
+            product_list = get_active_productlist(self.room.id)
+            self.assertEqual(_productlist_timeout(product_list), 3)
+
+    def test_expires_quickly(self):
+        # other processes only see a change once their cached list expires
+        self.assertEqual(_productlist_timeout(get_active_productlist(self.room.id)), PRODUCTLIST_CACHE_TIMEOUT)
+        self.assertLessEqual(PRODUCTLIST_CACHE_TIMEOUT, 5)
+
+
 class CategoryAdminTests(TestCase):
     fixtures = ["test_category"]
 
@@ -1276,6 +2121,51 @@ class MobilePaymentTests(TestCase):
         # mobilepayment count should remain unchanged
         self.assertEqual(MobilePayment.objects.count(), 6)
 
+    def test_csv_import_constant_queries(self):
+        from stregsystem.utils import parse_csv_and_create_mobile_payments
+
+        MobilePayment.objects.all().delete()
+        with open(self.fixture_path, "r") as csv_file:
+            lines = csv_file.readlines()
+
+        # existing transactions, members, lowered comments, savepoint, insert, release savepoint
+        with self.assertNumQueries(6):
+            imported, duplicates = parse_csv_and_create_mobile_payments(lines)
+        self.assertEqual((6, 0), (imported, duplicates))
+
+        # a repeated row in the same export is a duplicate as well
+        MobilePayment.objects.filter(transaction_id="241E027449465355").delete()
+        self.assertEqual((1, 11), parse_csv_and_create_mobile_payments(lines + lines[1:]))
+        self.assertEqual(
+            Member.objects.get(username="marx"), MobilePayment.objects.get(transaction_id="241E027449465355").member
+        )
+
+    def test_iter_decoded_lines(self):
+        from stregsystem.utils import iter_decoded_lines
+
+        data = "header\r\nfør;1\r\nefter;2\n\"sidste\";3".encode('utf-8')
+        # split everywhere, in the middle of ø and of \r\n as well
+        for size in range(1, len(data) + 1):
+            chunks = [data[i : i + size] for i in range(0, len(data), size)]
+            self.assertEqual(["header\r\n", "før;1\r\n", "efter;2\n", "\"sidste\";3"], list(iter_decoded_lines(chunks)))
+
+    def test_csv_upload_in_batches(self):
+        from django.core.files.uploadedfile import SimpleUploadedFile
+
+        MobilePayment.objects.all().delete()
+        with open(self.fixture_path, "rb") as csv_file:
+            upload = SimpleUploadedFile("export.csv", csv_file.read(), content_type="text/csv")
+
+        self.client.login(username="superuser", password="hunter2")
+        with patch('stregsystem.utils.MOBILE_PAYMENT_IMPORT_BATCH_SIZE', 4):
+            response = self.client.post(
+                reverse('mobilepaytool'), {'csv_file': upload, 'action': "Import MobilePay CSV"}
+            )
+
+        self.assertEqual(6, response.context['imports'])
+        self.assertEqual(0, response.context['duplicates'])
+        self.assertEqual(6, MobilePayment.objects.count())
+
     def test_member_exact_matching(self):
         for matched_member in MobilePayment.objects.filter(member__isnull=False):
             self.assertEqual(matched_member.member, Member.objects.get(pk=matched_member.member.pk))
@@ -1341,6 +2231,45 @@ class MobilePaymentTests(TestCase):
             member = Member.objects.get(pk=approved_mobile_payment.member.pk)
             self.assertEqual(member.balance, approved_mobile_payment.amount + self.members[member.username]['balance'])
 
+    def test_batch_submission_groups_payments_per_member(self):
+        tables = Member.objects.get(username__exact="tables")
+        MobilePayment.objects.filter(comment__icontains="tables").update(member=tables, status=MobilePayment.APPROVED)
+        MobilePayment.approve_member_filled_mobile_payments()
+
+        MobilePayment.submit_processed_mobile_payments(self.super_user)
+
+        # both of bobby's payments are applied, each with their own Payment
+        tables.refresh_from_db()
+        self.assertEqual(self.members['tables']['balance'] + 2 * 50000, tables.balance)
+        self.assertEqual(2, Payment.objects.filter(member=tables).count())
+        for mobile_payment in MobilePayment.objects.filter(status=MobilePayment.APPROVED):
+            self.assertEqual(mobile_payment.member, mobile_payment.payment.member)
+            self.assertEqual(mobile_payment.amount, mobile_payment.payment.amount)
+            self.assertTrue(
+                LogEntry.objects.filter(object_id=str(mobile_payment.payment.id), action_flag=ADDITION).exists()
+            )
+            self.assertTrue(
+                LogEntry.objects.filter(object_id=str(mobile_payment.id), change_message="Approved").exists()
+            )
+
+    def test_process_submitted_payments(self):
+        submitted_data = [
+            {
+                "id": MobilePayment.objects.get(transaction_id=transaction_id),
+                "member": Member.objects.get(username=username),
+                "status": MobilePayment.APPROVED,
+            }
+            for transaction_id, username in [("241E027449465355", "marx"), ("016E027417049990", "jdoe")]
+        ]
+        self.assertEqual(MobilePayment.process_submitted_mobile_payments(submitted_data, self.super_user), 2)
+
+        marx_payment = MobilePayment.objects.get(transaction_id="241E027449465355")
+        self.assertEqual(MobilePayment.APPROVED, marx_payment.status)
+        self.assertEqual(Member.objects.get(username="marx"), marx_payment.payment.member)
+        self.assertEqual(self.members['marx']['balance'] + 20000, Member.objects.get(username="marx").balance)
+        self.assertEqual(self.members['jdoe']['balance'] + 15000, Member.objects.get(username="jdoe").balance)
+        self.assertEqual(4, LogEntry.objects.count())
+
     def test_member_balance_on_delete_approved_mobilepayment(self):
         # member balance unchanged before submission
         self.assertEqual(Member.objects.get(username__exact="jdoe").balance, self.members["jdoe"]['balance'])
@@ -1407,6 +2336,16 @@ class MobilePaymentTests(TestCase):
     def test_exact_guess(self):
         self.assertEqual(Member.objects.get(username__exact="marx"), mobile_payment_exact_match_member("marx"))
 
+    def test_exact_guesses(self):
+        marx = Member.objects.get(username__exact="marx")
+        aero = Member.objects.create(username="Ærø")
+
+        self.assertEqual(
+            {"marx": marx, " MARX": marx, "Ærø": aero, "ÆRø ": aero},
+            mobile_payment_exact_match_members(["marx", " MARX", "Ærø", "ÆRø ", "nobody"]),
+        )
+        self.assertEqual(aero, mobile_payment_exact_match_member("ÆRø"))
+
     def test_emoji_strip(self):
         self.assertEqual(strip_emoji("Tilmeld Lichi 😎"), "Tilmeld Lichi ")
 
@@ -1451,3 +2390,303 @@ class MobilePaymentTests(TestCase):
                 self.assertEqual(e.inconsistent_mbpayments_count, 2)
                 self.assertEqual(e.inconsistent_transaction_ids, ["241E027449465355", "016E027417049990"])
                 raise e
+
+
+class FakeSMTPHandler(socketserver.StreamRequestHandler):
+    """
+    Just enough SMTP for smtplib to deliver mails to a FakeSMTPServer.
+    """
+
+    def reply(self, line):
+        self.wfile.write(line.encode() + b"\r\n")
+
+    def handle(self):
+        self.server.connections += 1
+        self.reply("220 localhost")
+        recipients = []
+        while True:
+            line = self.rfile.readline()
+            if not line:
+                return
+            command = line.decode().strip()
+            verb = command[:4].upper()
+            if verb in ("EHLO", "HELO"):
+                self.reply("250 localhost")
+            elif verb == "MAIL":
+                recipients = []
+                self.reply("250 OK")
+            elif verb == "RCPT":
+                recipient = command.split(":", 1)[1].strip(" <>")
+                if recipient in self.server.rejected:
+                    self.reply("450 Try again later")
+                else:
+                    recipients.append(recipient)
+                    self.reply("250 OK")
+            elif verb == "DATA":
+                self.reply("354 Go ahead")
+                data = b""
+                for data_line in iter(self.rfile.readline, b".\r\n"):
+                    data += data_line
+                self.server.messages.append((recipients, data.decode()))
+                self.reply("250 OK")
+            elif verb == "QUIT":
+                self.reply("221 Bye")
+                return
+            else:
+                self.reply("250 OK")
+
+
+class FakeSMTPServer(socketserver.ThreadingTCPServer):
+    daemon_threads = True
+
+    def __init__(self, rejected=()):
+        self.connections = 0
+        self.messages = []
+        self.rejected = set(rejected)
+        super().__init__(("127.0.0.1", 0), FakeSMTPHandler)
+
+
+class QueuedMailTests(TestCase):
+    def setUp(self):
+        self.server = FakeSMTPServer(rejected=["slow@example.com"])
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        self.addCleanup(self.server.server_close)
+        self.addCleanup(self.server.shutdown)
+        self.smtp_settings = self.settings(EMAIL_HOST="127.0.0.1", EMAIL_PORT=self.server.server_address[1])
+
+    def test_payment_queues_mail(self):
+        member = Member.objects.create(username="jokke", email="jokke@example.com", want_spam=True)
+        QueuedMail.objects.all().delete()
+
+        Payment(member=member, amount=10000).save()
+
+        mail = QueuedMail.objects.get()
+        self.assertEqual("jokke@example.com", mail.recipient)
+        self.assertIn("jokke", mail.message)
+        self.assertEqual(0, self.server.connections)
+
+    def test_welcome_mail_is_queued(self):
+        Member.objects.create(username="jokke", email="jokke@example.com")
+        Member.objects.create(username="nomail", email="")
+
+        self.assertEqual(["jokke@example.com"], list(QueuedMail.objects.values_list("recipient", flat=True)))
+
+    def test_send_over_one_connection(self):
+        for i in range(5):
+            send_email(f"member{i}@example.com", f"Subject: Mail {i}\r\n\r\nHej")
+
+        with self.smtp_settings:
+            out = StringIO()
+            call_command("sendqueuedmail", stdout=out)
+
+        self.assertIn("Sent 5 mails", out.getvalue())
+        self.assertEqual(1, self.server.connections)
+        self.assertEqual([[f"member{i}@example.com"] for i in range(5)], [to for to, _ in self.server.messages])
+        self.assertFalse(QueuedMail.objects.exists())
+
+    def test_overlapping_runs_send_once(self):
+        for i in range(2):
+            send_email(f"member{i}@example.com", f"Subject: Mail {i}\r\n\r\nHej")
+        sendmail = smtplib.SMTP.sendmail
+        overlapping = []
+
+        def sendmail_and_overlap(smtp, *args):
+            # another run starts while the first mail is being sent
+            if not overlapping:
+                overlapping.append(None)
+                overlapping[0] = send_queued_mail()
+            return sendmail(smtp, *args)
+
+        with self.smtp_settings, patch.object(smtplib.SMTP, "sendmail", sendmail_and_overlap):
+            self.assertEqual((1, 0), send_queued_mail())
+
+        self.assertEqual([(1, 0)], overlapping)
+        self.assertEqual(
+            [["member0@example.com"], ["member1@example.com"]], sorted(to for to, _ in self.server.messages)
+        )
+        self.assertFalse(QueuedMail.objects.exists())
+
+    def test_failed_mail_is_retried_with_backoff(self):
+        send_email("slow@example.com", "Subject: Slow\r\n\r\nHej")
+        send_email("fast@example.com", "Subject: Fast\r\n\r\nHej")
+        now = timezone.now()
+
+        with self.smtp_settings, freeze_time(now):
+            self.assertEqual((1, 1), send_queued_mail())
+            # not due yet
+            self.assertEqual((0, 0), send_queued_mail())
+
+        mail = QueuedMail.objects.get()
+        self.assertEqual(1, mail.attempts)
+        self.assertEqual(now + MAIL_RETRY_DELAY, mail.next_attempt)
+
+        self.server.rejected.clear()
+        with self.smtp_settings, freeze_time(now + MAIL_RETRY_DELAY):
+            self.assertEqual((1, 0), send_queued_mail())
+        self.assertFalse(QueuedMail.objects.exists())
+        self.assertEqual(2, len(self.server.messages))
+
+    def test_unreachable_server(self):
+        send_email("jokke@example.com", "Subject: Hej\r\n\r\nHej")
+        self.server.shutdown()
+        self.server.server_close()
+
+        with self.smtp_settings:
+            self.assertEqual((0, 1), send_queued_mail())
+        self.assertEqual(1, QueuedMail.objects.get().attempts)
+
+
+class FakeMobilePayHandler(http.server.BaseHTTPRequestHandler):
+    """
+    Serves the transactions of a FakeMobilePayServer from the requested time,
+    two per page.
+    """
+
+    protocol_version = "HTTP/1.1"
+
+    def do_GET(self):
+        url = urllib.parse.urlparse(self.path)
+        query = urllib.parse.parse_qs(url.query)
+        self.server.requests.append((self.client_address, query))
+        if "from" in query:
+            self.server.from_time = parse_datetime(query["from"][0])
+        transactions = [
+            transaction
+            for transaction in self.server.transactions
+            if parse_datetime(transaction["timestamp"]) >= self.server.from_time
+        ]
+        page = int(query.get("page", ["0"])[0])
+        body = {"transactions": transactions[page * 2 : page * 2 + 2]}
+        if page * 2 + 2 < len(transactions):
+            body["nextPageLink"] = f"{url.path}?page={page + 1}"
+        data = json.dumps(body).encode()
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def log_message(self, *args):
+        pass
+
+
+class FakeMobilePayServer(http.server.ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, transactions):
+        self.transactions = transactions
+        self.requests = []
+        self.from_time = None
+        super().__init__(("127.0.0.1", 0), FakeMobilePayHandler)
+
+
+class ImportMobilePayPaymentsTests(TestCase):
+    def setUp(self):
+        Member.objects.create(username="jdoe", email="jdoe@example.com")
+
+        def transaction(trans_id, comment, timestamp, type="Payment", currency="DKK"):
+            return {
+                "type": type,
+                "paymentTransactionId": trans_id,
+                "currencyCode": currency,
+                "amount": 50,
+                "senderComment": comment,
+                "timestamp": timestamp,
+            }
+
+        self.server = FakeMobilePayServer(
+            [
+                transaction("1", "jdoe", "2021-03-01T12:00:00.000+01:00"),
+                transaction("2", "unknown", "2021-03-02T12:00:00.000+01:00"),
+                transaction("3", "JDoe 😎", "2021-03-03T12:00:00.000+01:00"),
+                transaction("4", "jdoe", "2021-03-04T12:00:00.000+01:00", type="Transfer"),
+                transaction("5", "jdoe", "2021-03-05T12:00:00.000+01:00", currency="EUR"),
+            ]
+        )
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        self.addCleanup(self.server.server_close)
+        self.addCleanup(self.server.shutdown)
+
+        tokens_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(tokens_dir.cleanup)
+        self.tokens_file = os.path.join(tokens_dir.name, "tokens.json")
+        with open(self.tokens_file, "w") as f:
+            json.dump(
+                {
+                    "paymentpoint": "pp",
+                    "ibm-client-secret": "secret",
+                    "ibm-client-id": "id",
+                    "access_token": "token",
+                    "access_token_timeout": "2999-01-01T00:00:00.000",
+                },
+                f,
+            )
+
+        api_endpoint = f"http://127.0.0.1:{self.server.server_address[1]}"
+        for attribute, value in [("api_endpoint", api_endpoint), ("tokens_file", self.tokens_file)]:
+            patcher = patch.object(importmobilepaypayments.Command, attribute, value)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    def tokens(self):
+        with open(self.tokens_file) as f:
+            return json.load(f)
+
+    def test_import_pages(self):
+        with freeze_time(datetime.datetime(2021, 3, 6, tzinfo=pytz.UTC)):
+            call_command("importmobilepaypayments")
+
+        self.assertEqual(["1", "2", "3"], sorted(MobilePayment.objects.values_list("transaction_id", flat=True)))
+        jdoe = Member.objects.get(username="jdoe")
+        self.assertEqual(jdoe, MobilePayment.objects.get(transaction_id="1").member)
+        self.assertEqual(5000, MobilePayment.objects.get(transaction_id="1").amount)
+        self.assertIsNone(MobilePayment.objects.get(transaction_id="2").member)
+        # all pages fetched over the same connection
+        self.assertEqual(3, len(self.server.requests))
+        self.assertEqual(1, len({client for client, _ in self.server.requests}))
+        self.assertEqual("2021-03-06T00:00:00+00:00", self.tokens()["transactions_cursor"])
+
+    def test_continue_from_cursor(self):
+        with freeze_time(datetime.datetime(2021, 3, 6, tzinfo=pytz.UTC)):
+            call_command("importmobilepaypayments")
+        self.server.requests.clear()
+
+        # the next import starts a little before the last fetch, and only fetches what is new since
+        with self.assertNumQueries(0), freeze_time(datetime.datetime(2021, 3, 10, tzinfo=pytz.UTC)):
+            call_command("importmobilepaypayments")
+
+        from_time = parse_datetime(self.server.requests[0][1]["from"][0])
+        self.assertEqual(datetime.datetime(2021, 3, 5, 18, tzinfo=pytz.UTC), from_time)
+        self.assertEqual(3, MobilePayment.objects.count())
+        self.assertEqual("2021-03-10T00:00:00+00:00", self.tokens()["transactions_cursor"])
+
+    def test_late_transaction(self):
+        with freeze_time(datetime.datetime(2021, 3, 6, tzinfo=pytz.UTC)):
+            call_command("importmobilepaypayments")
+
+        # a payment showing up in the API a while after its timestamp is still imported
+        self.server.transactions.append(
+            dict(self.server.transactions[0], paymentTransactionId="6", timestamp="2021-03-05T22:00:00.000+01:00")
+        )
+        # and with a longer overlap, one showing up days after
+        self.server.transactions.append(
+            dict(self.server.transactions[0], paymentTransactionId="7", timestamp="2021-03-04T12:00:00.000+01:00")
+        )
+        with freeze_time(datetime.datetime(2021, 3, 8, tzinfo=pytz.UTC)):
+            call_command("importmobilepaypayments")
+        self.assertTrue(MobilePayment.objects.filter(transaction_id="6").exists())
+        self.assertFalse(MobilePayment.objects.filter(transaction_id="7").exists())
+
+        with freeze_time(datetime.datetime(2021, 3, 8, tzinfo=pytz.UTC)):
+            call_command("importmobilepaypayments", "--overlap-hours=96")
+        self.assertTrue(MobilePayment.objects.filter(transaction_id="7").exists())
+
+    def test_days_back_overrides_cursor(self):
+        call_command("importmobilepaypayments")
+        self.server.requests.clear()
+
+        with freeze_time(datetime.datetime(2021, 3, 20, tzinfo=pytz.UTC)):
+            call_command("importmobilepaypayments", "10")
+
+        from_time = parse_datetime(self.server.requests[0][1]["from"][0])
+        self.assertEqual(datetime.datetime(2021, 3, 10, tzinfo=pytz.UTC), from_time)
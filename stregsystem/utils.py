@@ -1,16 +1,18 @@
+import codecs
+import itertools
 import logging
 import re
-import smtplib
+from typing import NamedTuple
 
 from django.utils.dateparse import parse_datetime
 from email.mime.multipart import MIMEMultipart
 from email.mime.text import MIMEText
 from django.conf import settings
-from django.core.exceptions import ValidationError
 from django.http import HttpResponse
 from django.test.runner import DiscoverRunner
 
-from django.db.models import Count, F, Q, QuerySet
+from django.db import connection, transaction
+from django.db.models import BooleanField, Case, F, Q, QuerySet, Value, When
 from django.utils import timezone
 from stregsystem.templatetags.stregsystem_extras import money
 
@@ -20,37 +22,31 @@ import qrcode.image.svg
 logger = logging.getLogger(__name__)
 
 
-def make_active_productlist_query(queryset) -> QuerySet:
+def make_active_product_condition() -> Q:
     now = timezone.now()
-    # Create a query for the set of products that MIGHT be active. Might
-    # because they can be out of stock. Which we compute later
-    active_candidates = queryset.filter(Q(active=True) & (Q(deactivate_date=None) | Q(deactivate_date__gte=now)))
-    # This query selects all the candidates that are out of stock.
-    candidates_out_of_stock = (
-        active_candidates.filter(sale__timestamp__gt=F("start_date"))
-        .annotate(c=Count("sale__id"))
-        .filter(c__gte=F("quantity"))
-        .values("id")
+    # A product is active if it is activated, not expired and not out of
+    # stock. Only limited products can run out of stock.
+    return (
+        Q(active=True)
+        & (Q(deactivate_date=None) | Q(deactivate_date__gte=now))
+        & ~(Q(start_date__isnull=False) & Q(bought_count__gte=F("quantity")))
     )
-    # We can now create a query that selects all the candidates which are not
-    # out of stock.
-    return active_candidates.exclude(Q(start_date__isnull=False) & Q(id__in=candidates_out_of_stock))
 
 
-def make_inactive_productlist_query(queryset) -> QuerySet:
-    now = timezone.now()
-    # Create a query of things are definitively inactive. Some of the ones
-    # filtered here might be out of stock, but we include that later.
-    inactive_candidates = queryset.exclude(
-        Q(active=True) & (Q(deactivate_date=None) | Q(deactivate_date__gte=now))
-    ).values("id")
-    inactive_out_of_stock = (
-        queryset.filter(sale__timestamp__gt=F("start_date"))
-        .annotate(c=Count("sale__id"))
-        .filter(c__gte=F("quantity"))
-        .values("id")
+def annotate_product_activated(queryset) -> QuerySet:
+    return queryset.annotate(
+        activated=Case(
+            When(make_active_product_condition(), then=Value(True)), default=Value(False), output_field=BooleanField()
+        )
     )
-    return queryset.filter(Q(id__in=inactive_candidates) | Q(id__in=inactive_out_of_stock))
+
+
+def make_active_productlist_query(queryset) -> QuerySet:
+    return queryset.filter(make_active_product_condition())
+
+
+def make_inactive_productlist_query(queryset) -> QuerySet:
+    return queryset.exclude(make_active_product_condition())
 
 
 def make_room_specific_query(room) -> QuerySet:
@@ -94,8 +90,6 @@ def date_to_midnight(date):
 
 
 def send_payment_mail(member, amount):
-    if hasattr(settings, 'TEST_MODE'):
-        return
     msg = MIMEMultipart()
     msg['From'] = 'treo@fklub.dk'
     msg['To'] = member.email
@@ -126,52 +120,157 @@ def send_payment_mail(member, amount):
 
     msg.attach(MIMEText(html, 'html'))
 
-    try:
-        smtpObj = smtplib.SMTP('localhost', 25)
-        smtpObj.sendmail('treo@fklub.dk', member.email, msg.as_string())
-    except Exception as e:
-        logger.error(str(e))
+    from stregsystem.mail import send_email  # import locally to avoid circular import
+
+    send_email(member.email, msg.as_string())
+
+
+# Number of MobilePayments handled at a time when importing a CSV export
+MOBILE_PAYMENT_IMPORT_BATCH_SIZE = 500
+
+
+class MobilePaymentImportSummary(NamedTuple):
+    imported: int
+    duplicates: int
+
+
+def iter_decoded_lines(chunks, encoding='utf-8'):
+    """
+    Decodes a stream of byte chunks, e.g. UploadedFile.chunks(), and yields
+    it line by line, keeping the line endings. Only one chunk and one line
+    are kept in memory at a time.
+    """
+    decoder = codecs.getincrementaldecoder(encoding)()
+    pending = ''
+    for chunk in chunks:
+        lines = (pending + decoder.decode(chunk)).splitlines(keepends=True)
+        # The last line may continue in the next chunk, and so may a \r\n
+        # line ending
+        pending = lines.pop() if lines and not lines[-1].endswith('\n') else ''
+        yield from lines
+    pending += decoder.decode(b'', final=True)
+    yield from pending.splitlines(keepends=True)
 
 
 def parse_csv_and_create_mobile_payments(csv_file):
-    imported_transactions, duplicate_transactions = 0, 0
+    """
+    Imports the MobilePay transactions of a CSV export. csv_file is an
+    iterable of the lines of the export, including the header, and it is
+    consumed a batch at a time, so the export can be of any size.
+
+    Returns a summary with the number of imported transactions, and the
+    number of transactions which had already been imported.
+    """
     import csv
 
     # get csv reader and ignore header
-    reader = csv.reader(csv_file[1:], delimiter=';', quotechar='"')
-    for row in reader:
-
-        from stregsystem.models import MobilePayment
-
-        mobile_payment = MobilePayment(
-            member=None,
+    lines = iter(csv_file)
+    next(lines, None)
+    reader = csv.reader(lines, delimiter=';', quotechar='"')
+    rows = (
+        dict(
             amount=row[2].replace(',', ''),
             timestamp=parse_datetime(row[3]),
             customer_name=row[4],
             transaction_id=row[7],
             comment=row[6],
-            payment=None,
         )
-        try:
-            # unique constraint on transaction_id and payment-foreign key must hold before saving new object
-            mobile_payment.validate_unique()
+        for row in reader
+        if row
+    )
+
+    imported_transactions, duplicate_transactions = 0, 0
+    seen_transaction_ids = set()
+    with transaction.atomic():
+        while True:
+            batch = list(itertools.islice(rows, MOBILE_PAYMENT_IMPORT_BATCH_SIZE))
+            if not batch:
+                break
+            imported = _create_mobile_payments(batch, seen_transaction_ids)
+            imported_transactions += imported
+            duplicate_transactions += len(batch) - imported
+            logger.debug(
+                f"MobilePay CSV import: {imported_transactions + duplicate_transactions} rows read, "
+                f"{imported_transactions} imported"
+            )
+    return MobilePaymentImportSummary(imported_transactions, duplicate_transactions)
+
+
+def _create_mobile_payments(rows, seen_transaction_ids):
+    """
+    Creates the MobilePayments of a batch of CSV rows, skipping the ones
+    already in the database or in seen_transaction_ids. Returns the number
+    created.
+    """
+    from stregsystem.models import MobilePayment
+
+    # transaction_id is unique, so skip the transactions we already have
+    # (and the ones repeated in the export)
+    seen_transaction_ids.update(
+        MobilePayment.objects.filter(transaction_id__in={row['transaction_id'] for row in rows}).values_list(
+            'transaction_id', flat=True
+        )
+    )
+    members = mobile_payment_exact_match_members(row['comment'] for row in rows)
+
+    mobile_payments = []
+    for row in rows:
+        if row['transaction_id'] in seen_transaction_ids:
+            continue
+        seen_transaction_ids.add(row['transaction_id'])
+        # do case insensitive exact match on active members
+        mobile_payments.append(MobilePayment(member=members.get(row['comment']), payment=None, **row))
+
+    MobilePayment.objects.bulk_create(mobile_payments)
+    return len(mobile_payments)
+
+
+def _lower_in_database(values):
+    """
+    Lowercases the values the way the database does, which may differ from
+    str.lower. SQLite only folds ASCII, for one.
+    """
+    values = list(values)
+    lowered = {}
+    with connection.cursor() as cursor:
+        for start in range(0, len(values), 500):
+            batch = values[start : start + 500]
+            cursor.execute("SELECT " + ", ".join(["LOWER(%s)"] * len(batch)), batch)
+            lowered.update(zip(batch, cursor.fetchone()))
+    return lowered
+
+
+def mobile_payment_exact_match_members(comments):
+    """
+    Does mobile_payment_exact_match_member for many comments with constant
+    queries. Returns a dict from each comment matching a member to the member.
+    """
+    from stregsystem.models import Member
 
-            # do case insensitive exact match on active members
-            mobile_payment.member = mobile_payment_exact_match_member(mobile_payment.comment)
-            mobile_payment.save()
-            imported_transactions += 1
-        except ValidationError:
-            duplicate_transactions += 1
-    return imported_transactions, duplicate_transactions
+    usernames = {comment: comment.strip() for comment in comments}
+    if not usernames:
+        return {}
+    members = {}
+    for member in Member.with_usernames(usernames.values()).filter(active=True):
+        if member.username_lower in members:
+            # something is very wrong, there should be no active users which are duplicates post PR #178
+            raise RuntimeError("Duplicate usernames found at MobilePayment import. Should not exist post PR #178")
+        members[member.username_lower] = member
+    if not members:
+        return {}
+    lowered = _lower_in_database(set(usernames.values()))
+    return {
+        comment: members[lowered[username]] for comment, username in usernames.items() if lowered[username] in members
+    }
 
 
 def mobile_payment_exact_match_member(comment):
     from stregsystem.models import Member
 
-    match = Member.objects.filter(username__iexact=comment.strip(), active=True)
-    if match.count() == 1:
-        return match.get()
-    elif match.count() > 1:
+    match = list(Member.with_username(comment.strip()).filter(active=True)[:2])
+    if len(match) == 1:
+        return match[0]
+    elif len(match) > 1:
         # something is very wrong, there should be no active users which are duplicates post PR #178
         raise RuntimeError("Duplicate usernames found at MobilePayment import. Should not exist post PR #178")
 
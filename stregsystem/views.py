@@ -6,7 +6,8 @@ from django.forms import modelformset_factory, formset_factory
 from django.contrib.admin.views.decorators import staff_member_required
 from django.contrib.auth.decorators import permission_required
 from django.conf import settings
-from django.db.models import Q
+from django.db import transaction
+from django.db.models import Count, Min, Q
 from django import forms
 from django.http import HttpResponsePermanentRedirect, HttpResponseBadRequest
 from django.shortcuts import get_object_or_404, render
@@ -15,6 +16,7 @@ from django_select2 import forms as s2forms
 import urllib.parse
 
 from stregsystem import parser
+from stregsystem.caches import get_active_productlist
 from stregsystem.models import (
     Member,
     Payment,
@@ -28,10 +30,9 @@ from stregsystem.models import (
     MobilePayment,
 )
 from stregsystem.utils import (
-    make_active_productlist_query,
     qr_code,
-    make_room_specific_query,
     make_unprocessed_mobilepayment_query,
+    iter_decoded_lines,
     parse_csv_and_create_mobile_payments,
     MobilePaytoolException,
 )
@@ -48,7 +49,7 @@ def __get_news():
 
 
 def __get_productlist(room_id):
-    return make_active_productlist_query(Product.objects).filter(make_room_specific_query(room_id))
+    return get_active_productlist(room_id)
 
 
 def roomindex(request):
@@ -89,7 +90,7 @@ def sale(request, room_id):
         return render(request, 'stregsystem/error_invalidquickbuy.html', values)
     # Fetch member from DB
     try:
-        member = Member.objects.get(username=username, active=True)
+        member = Member.with_username(username, exact=True).get(active=True)
     except Member.DoesNotExist:
         return render(request, 'stregsystem/error_usernotfound.html', locals())
 
@@ -102,18 +103,24 @@ def sale(request, room_id):
 def _multibuy_hint(now, member):
     # Get a timestamp to fetch sales for the member for the last 60 sec
     earliest_recent_purchase = now - datetime.timedelta(seconds=60)
-    # get the sales with this timestamp
-    recent_purchases = Sale.objects.filter(member=member, timestamp__gt=earliest_recent_purchase)
-    number_of_recent_distinct_purchases = recent_purchases.values('timestamp').distinct().count()
+    # count the sales of each product at each timestamp, ordered by when the
+    # product was first bought, in a single query
+    recent_purchases = (
+        Sale.objects.filter(member=member, timestamp__gt=earliest_recent_purchase)
+        .values('timestamp', 'product_id')
+        .annotate(count=Count('id'), first_sale=Min('id'))
+        .order_by('first_sale')
+    )
+
+    sale_dict = {}
+    timestamps = set()
+    for purchase in recent_purchases:
+        timestamps.add(purchase['timestamp'])
+        key = str(purchase['product_id'])
+        sale_dict[key] = sale_dict.get(key, 0) + purchase['count']
 
     # add hint for multibuy
-    if number_of_recent_distinct_purchases > 1:
-        sale_dict = {}
-        for sale in recent_purchases:
-            if not str(sale.product.id) in sale_dict:
-                sale_dict[str(sale.product.id)] = 1
-            else:
-                sale_dict[str(sale.product.id)] = sale_dict[str(sale.product.id)] + 1
+    if len(timestamps) > 1:
         sale_hints = ["<span class=\"username\">{}</span>".format(member.username)]
         for key in sale_dict:
             if sale_dict[key] > 1:
@@ -125,24 +132,33 @@ def _multibuy_hint(now, member):
     return (False, None)
 
 
+def _resolve_products(bought_ids, room, now):
+    """
+    Fetch every distinct product id of a quickbuy in a single query.
+
+    Returns a dict from product id to product, containing only the ids that
+    are buyable in the given room right now.
+    """
+    products = Product.objects.filter(
+        Q(pk__in=set(bought_ids)),
+        Q(active=True),
+        Q(deactivate_date__gte=now) | Q(deactivate_date__isnull=True),
+        Q(rooms__id=room.id) | Q(rooms=None),
+    ).distinct()
+    return {product.id: product for product in products}
+
+
 def quicksale(request, room, member, bought_ids):
     news = __get_news()
     product_list = __get_productlist(room.id)
     now = timezone.now()
 
     # Retrieve products and construct transaction
-    products = []
-    try:
-        for i in bought_ids:
-            product = Product.objects.get(
-                Q(pk=i),
-                Q(active=True),
-                Q(deactivate_date__gte=now) | Q(deactivate_date__isnull=True),
-                Q(rooms__id=room.id) | Q(rooms=None),
-            )
-            products.append(product)
-    except Product.DoesNotExist:
-        return render(request, 'stregsystem/error_productdoesntexist.html', {'failedProduct': i, 'room': room})
+    products_by_id = _resolve_products(bought_ids, room, now)
+    for i in bought_ids:
+        if i not in products_by_id:
+            return render(request, 'stregsystem/error_productdoesntexist.html', {'failedProduct': i, 'room': room})
+    products = [products_by_id[i] for i in bought_ids]
 
     order = Order.from_products(member=member, products=products, room=room)
 
@@ -269,27 +285,12 @@ def batch_payment(request):
     if request.method == "POST":
         formset = PaymentFormSet(request.POST, request.FILES)
         if formset.is_valid():
-            # @HACK For some reason django formsets get different member
-            # instances with the same values instead of the same instance. This
-            # means that if we update the member balance and save it, then
-            # repeat, the second write will overwrite the first. In case you
-            # don't know, that's not good.
-            # To work around this we have to set all the member instances to be
-            # the same if they have the same id. This is very, although
-            # slightly less, bad - Jesper Jensen 16/02-2017
-            payments = formset.save(commit=False)
-
-            # @HACK: We need to consolidate all the member so they are the same
-            # instances. We do this by just saving the first one and setting
-            # all the remaining with the same id to be that instance aswell.
-            members = {}
-            for payment in payments:
-                if payment.member.id not in members:
-                    members[payment.member.id] = payment.member
-                payment.member = members[payment.member.id]
-
-            for payment in payments:
-                payment.save()
+            # Payments add to the balance in the database, so it doesn't
+            # matter that the formset gives every payment its own member
+            # instance, even when they are the same member
+            with transaction.atomic():
+                for payment in formset.save(commit=False):
+                    payment.save()
 
             return render(request, "admin/stregsystem/batch_payment_done.html", {})
     else:
@@ -316,12 +317,12 @@ def mobilepaytool(request):
     if request.method == "GET":
         data['formset'] = paytool_form_set(queryset=make_unprocessed_mobilepayment_query())
     elif request.method == "POST" and 'csv_file' in request.FILES and request.POST['action'] == "Import MobilePay CSV":
-        # Prepare uploaded CSV to be read
+        # Read the uploaded CSV a chunk at a time
         csv_file = request.FILES['csv_file']
         csv_file.seek(0)
 
         data['imports'], data['duplicates'] = parse_csv_and_create_mobile_payments(
-            str(csv_file.read().decode('utf-8')).splitlines()
+            iter_decoded_lines(csv_file.chunks())
         )
 
         # refresh form after submission